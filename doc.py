@@ -12,6 +12,11 @@ installed. For details of usage see help::
 
     $ markdown2latex.py -h
 
+To convert many files at once, give an output directory and the number of
+processes to use::
+
+    $ markdown2latex.py -o latex/ -j 4 chapters/ appendix/*.md
+
 2. As a python-markdown extension::
 
     >>> import markdown
@@ -28,6 +33,49 @@ installed. For details of usage see help::
     >>> latex_mdx.extendMarkdown(md, markdown.__dict__)
     >>> out = md.convert(text)
 
+4. To convert many documents, build one converter and reuse it (in one
+thread)::
+
+    >>> import mdx_latex
+    >>> converter = mdx_latex.LaTeXConverter()
+    >>> out = converter.convert(text)
+
+5. To write a document to a file a block at a time, optionally in place of
+INSERT-TEXT-HERE in a template, without joining the LaTeX into one string
+first (markdown still holds the whole document while converting it, so
+this saves copies of the output rather than much memory)::
+
+    >>> with open('out.tex', 'w') as fo:
+    ...     converter.convert_to(text, fo, template_text)
+
+6. A template is split at its slots once and can then be filled in any
+number of times. Besides INSERT-TEXT-HERE a template may have other slots,
+such as INSERT-TITLE-HERE, filled in by name (with --slot title=... on the
+command line)::
+
+    >>> tmpl = mdx_latex.load_template('template.tex')
+    >>> with open('out.tex', 'w') as fo:
+    ...     converter.convert_to(text, fo, tmpl, title='A title')
+
+7. To change how an element is output, or output one the extension does
+not know, register an emitter for its tag::
+
+    >>> converter.extension.register_emitter(
+    ...     'h5', mdx_latex.wrapper('\\\\paragraph{', '}\\n'))
+
+An emitter with a true skip_children attribute is called without the
+children of the node being converted first, for elements it converts
+whole, such as tables and images.
+
+8. To find out where a slow conversion spends its time, have the extension
+count the calls, time and characters in and out of each stage, and time
+each remote image (or use --profile on the command line, and
+--profile-output to write cProfile stats too)::
+
+    >>> stats = converter.extension.instrument()
+    >>> out = converter.convert(text)
+    >>> print(stats.summary())
+
 History
 =======
 
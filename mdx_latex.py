@@ -3,41 +3,133 @@
 # in this file while still importing * for use in our own classes
 import re
 import sys
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import shutil
+import stat
+import threading
+import time
+import tracemalloc
 import markdown
 import xml.dom.minidom
+import xml.parsers.expat
 import xml.etree.ElementTree as etree
-from urllib.parse import urlparse
+from urllib.parse import unquote, urljoin, urlparse
 import http.client
 import os
 import tempfile
-import urllib.request, urllib.parse, urllib.error
 
 
-start_single_quote_re = re.compile("(^|\s|\")'")
-start_double_quote_re = re.compile("(^|\s|'|`)\"")
-end_double_quote_re = re.compile("\"(,|\.|\s|$)")
+# the quote entities smarty leaves in the text
+quote_entity_re = re.compile(r'&([lr]dquo|[lr]squo|[lr]aquo);')
+# the quotes other than double ones
+other_quotes = ('lsquo', 'rsquo', 'laquo', 'raquo')
+# what each quote becomes when it is not part of a pair
+quote_entities = {
+    'ldquo': '``', 'rdquo': "''", 'lsquo': '`', 'rsquo': "'",
+    'laquo': '\\guillemotleft{}', 'raquo': '\\guillemotright{}',
+}
+# the opening quote for each closing one
+closing_quotes = {'rdquo': 'ldquo', 'rsquo': 'lsquo', 'raquo': 'laquo'}
+opening_quotes = {'ldquo': 'rdquo', 'lsquo': 'rsquo', 'laquo': 'raquo'}
+# the other rewrites, none of which can overlap a quote or each other
+inline_html_map = [
+    ('...', '\\dots'),
+    ('&hellip;', '\\dots'),
+    ('&ndash;', '--'),
+    ('&mdash;', '---'),
+    # we should already have processed the tables and do not need it in
+    # LaTeX
+    ('\\|', '|'),
+]
+
 
 def inline_html_latex(text):
-    out = text
-    # most of them to support smarty extensions
-    if re.search(r'&ldquo;.*?&rdquo;', text , flags=re.DOTALL):
-        out = out.replace('&ldquo;', '\enquote{').replace('&rdquo;', '}')
-    # replace certain html element with they LaTeX eqivarent
-    if re.search(r'&lsquo;.*?&rsquo;', text , flags=re.DOTALL):
-        out = out.replace('&lsquo;', '\enquote{').replace('&rsquo;', '}')
-    if re.search(r'&ldquo;.*?&ldquo;', text , flags=re.DOTALL):
-        # sometimes is processing like this
-        out = out.replace('&ldquo;', '\enquote{', 1).replace('&ldquo;', '}', 1)
-    if re.search(r'&laquo;.*?&raquo;', text , flags=re.DOTALL):
-        out = out.replace('&laquo;', '\enquote{').replace('&raquo;', '}')
-    out = out.replace("...", "\dots")
-    out = out.replace("&hellip;", "\dots")
-    out = out.replace("&ndash;", "--")
-    out = out.replace("&mdash;", "---")    
-    # replace '\|' as we should already processed the tables and do not need in LaTeX
-    out = out.replace("\|", '|')
-    return out 
-        
+    """Replace the quote, dash and ellipsis entities (most of them from the
+    smarty extension), '...' and '\\|' in text with their LaTeX equivalent.
+
+    The quotes are found in one scan and paired up, innermost first, and
+    each pair becomes \\enquote{...}, so quotes within quotes come out
+    right. A right single quote followed by a letter or digit is an
+    apostrophe. Left double quotes left over are paired with each other, as
+    smarty sometimes makes both quotes left ones, and any quotes still left
+    are plain LaTeX quotes.
+    """
+    for old, new in inline_html_map:
+        if old in text:
+            text = text.replace(old, new)
+    # after the other entities are gone, so that enquote can tell from the
+    # number of &s whether there are any but quotes
+    if '&' in text:
+        text = enquote(text)
+    return text
+
+
+def enquote(text):
+    """Pair up the quote entities in text for inline_html_latex."""
+    pieces = text.split('&ldquo;')
+    counts = list(map(str.count, pieces, itertools.repeat('&rdquo;')))
+    # single quotes and guillemets of a kind with no opening, or no
+    # closing, ones are never paired, so they are replaced wholesale
+    unpaired = []
+    simple = True
+    # unless every & starts a double quote, look for the other quotes
+    if text.count('&') != len(pieces) - 1 + sum(counts):
+        names = set(name for name in other_quotes
+                    if '&%s;' % name in text)
+        for name in names:
+            if closing_quotes.get(name, opening_quotes.get(name)) not in names:
+                unpaired.append(('&%s;' % name, quote_entities[name]))
+        simple = len(unpaired) == len(names)
+    if simple and counts[0] == 0 and counts.count(1) == len(counts) - 1:
+        # the usual case of double quotes, if any, opened and closed in
+        # turn: after each left quote but the first comes exactly one right
+        # one
+        if len(pieces) > 1:
+            text = '\\enquote{'.join(pieces).replace('&rdquo;', '}')
+        for entity, quote in unpaired:
+            text = text.replace(entity, quote)
+        return text
+    for entity, quote in unpaired:
+        text = text.replace(entity, quote)
+    # text between the quotes at even indices, quote names at odd ones
+    parts = quote_entity_re.split(text)
+    if len(parts) == 1:
+        return text
+    # (name, index in parts) of the opening quotes not closed yet, and how
+    # many of each there are
+    stack = []
+    open_counts = dict.fromkeys(closing_quotes.values(), 0)
+    for index in range(1, len(parts), 2):
+        name = parts[index]
+        if name in open_counts:
+            stack.append((name, index))
+            open_counts[name] += 1
+            parts[index] = quote_entities[name]
+        elif not open_counts[closing_quotes[name]]:
+            parts[index] = quote_entities[name]
+        elif name == 'rsquo' and parts[index + 1][:1].isalnum():
+            parts[index] = "'"
+        else:
+            opening = closing_quotes[name]
+            # quotes opened inside this pair and not closed stay unpaired
+            while stack[-1][0] != opening:
+                open_counts[stack.pop()[0]] -= 1
+            parts[stack.pop()[1]] = '\\enquote{'
+            open_counts[opening] -= 1
+            parts[index] = '}'
+    left = [index for name, index in stack if name == 'ldquo']
+    for start, end in zip(left[::2], left[1::2]):
+        parts[start] = '\\enquote{'
+        parts[end] = '}'
+    return ''.join(parts)
+
 
 def unescape_html_entities(text):
     out = text.replace('&amp;', '&')
@@ -47,22 +139,68 @@ def unescape_html_entities(text):
     return out
 
 
+# an & not starting an entity, as unescape_html_entities leaves them
+bare_amp_re = re.compile(r'&(?!#?\w+;)')
+
+
+def escape_bare_ampersands(text):
+    """Return text with each & not starting an entity as &amp;, so that
+    html which has been through unescape_html_entities parses as XML."""
+    if '&' not in text:
+        return text
+    return bare_amp_re.sub('&amp;', text)
+
+
+# Everything escape_latex_entities rewrites, as (pattern, replacement) pairs
+# that are matched in a single scan. Html entities are decoded as though
+# '&amp;' were decoded before the others (so '&amp;lt;' is '<') and the quote
+# rules look at the decoded neighbours of each quote: an opening single quote
+# follows the start of the text, whitespace or a double quote, an opening
+# double quote follows the start, whitespace or another quote, and a closing
+# double quote is followed by punctuation, whitespace or the end. Every
+# pattern starts with a literal character so that the scan can skip quickly
+# over plain text.
+latex_escapes = [
+    (r"""'(?:(?<![^\s"]')|(?<=&quot;')|(?<=&amp;quot;'))""", '`'),
+    (r'"(?<![^\s\'`]")', '``'),
+    (r"""&quot;(?<![^\s'`]&quot;)""", '``'),
+    (r"""&amp;quot;(?<![^\s'`]&amp;quot;)""", '``'),
+    (r'"(?=[,.\s]|\Z)', "''"),
+    (r'&(?:amp;)?quot;(?=[,.\s]|\Z)', "''"),
+    (r'&(?:amp;)?quot;', '"'),
+    (r'&(?:amp;)?lt;', '<'),
+    (r'&(?:amp;)?gt;', '>'),
+    (r'&(?:amp;)?', '\\&'),
+    (r'%', '\\%'),
+    (r'#', '\\#'),
+]
+# each pattern is followed by an empty group so that lastindex identifies
+# the one that matched
+latex_escape_re = re.compile('|'.join('%s()' % pattern
+                                      for pattern, _ in latex_escapes))
+latex_escape_repl = [None] + [repl for _, repl in latex_escapes]
+
+
 def escape_latex_entities(text):
-    """Escape latex reserved characters."""
-    out = text
-    out = unescape_html_entities(out)
-    out = out.replace('%', '\\%')
-    out = out.replace('&', '\\&')
-    out = out.replace('#', '\\#')
-    out = start_single_quote_re.sub('\g<1>`', out)
-    out = start_double_quote_re.sub('\g<1>``', out)
-    out = end_double_quote_re.sub("''\g<1>", out)
-    # people should escape these themselves as it conflicts with maths
-    # out = out.replace('{', '\\{')
-    # out = out.replace('}', '\\}')
-    # do not do '$' here because it is dealt with by convert_maths
-    # out = out.replace('$', '\\$')
-    return out
+    """Escape latex reserved characters.
+
+    Html entities are unescaped first, and straight quotes are turned into
+    latex opening and closing quotes.
+    """
+    # people should escape '{' and '}' themselves as it conflicts with maths
+    # and '$' is not done here because it is dealt with by convert_maths
+    return latex_escape_re.sub(
+        lambda m: latex_escape_repl[m.lastindex], text)
+
+
+def margins(text):
+    """Return the whitespace that str.strip() would strip off the start
+    and end of text."""
+    stripped = text.strip()
+    if not stripped:
+        return text, ''
+    start = text.index(stripped[0])
+    return text[:start], text[start + len(stripped):]
 
 
 def unescape_latex_entities(text):
@@ -72,12 +210,65 @@ def unescape_latex_entities(text):
     return out
 
 
-def makeExtension(configs=None):
-    return LaTeXExtension(configs=configs)
+def walk(root, enter, leave=None, children=iter):
+    """Walk the tree under root depth first, using an explicit stack rather
+    than recursion so that arbitrarily deep trees can be handled.
+
+    enter(node) is called on the way down; if it returns False the node's
+    children are skipped. leave(node), if given, is called on the way back up
+    once all of the node's children have been left. children(node) returns an
+    iterable over the children of node and by default iterates over the node
+    itself, as for ElementTree elements.
+    """
+    if enter(root) is False:
+        if leave is not None:
+            leave(root)
+        return
+    stack = [(root, iter(children(root)))]
+    while stack:
+        node, kids = stack[-1]
+        for child in kids:
+            if enter(child) is False:
+                if leave is not None:
+                    leave(child)
+                continue
+            stack.append((child, iter(children(child))))
+            break
+        else:
+            stack.pop()
+            if leave is not None:
+                leave(node)
+
+
+def makeExtension(configs=None, **kwargs):
+    return LaTeXExtension(configs=configs, **kwargs)
 
 
 class LaTeXExtension(markdown.Extension):
-    def __init__(self, configs=None):
+    def __init__(self, configs=None, **kwargs):
+        self.config = {
+            'image_workers': [1, 'Number of remote images to download at '
+                                 'once (1 downloads them one by one)'],
+            'image_cache_dir': ['', 'Directory to keep downloaded images in '
+                                    'between runs (none by default)'],
+            'image_cache_size': [512, 'Size in megabytes above which the '
+                                      'least recently used images are '
+                                      'dropped from the image cache'],
+            'image_timeout': [30, 'Seconds to wait on an image server '
+                                  'before giving up on an image'],
+            'image_max_size': [64, 'Size in megabytes above which remote '
+                                   'images are not downloaded'],
+            'longtable_rows': [0, 'Number of rows above which tables are '
+                                  'output as longtables (0 for never)'],
+        }
+        # shared with the tree processor, so emitters may be registered
+        # before or after extendMarkdown
+        self.emitters = dict(LaTeXTreeProcessor.default_emitters)
+        # a ConversionStats once instrument() has been called
+        self.stats = None
+        super().__init__(**kwargs)
+        if configs:
+            self.setConfigs(configs)
         self.reset()
 
     def extendMarkdown(self, md):
@@ -90,139 +281,855 @@ class LaTeXExtension(markdown.Extension):
         #         self.md.inlinePatterns.pop(key)
         #         break
 
-        #footnote_extension = FootnoteExtension()
-        #footnote_extension.extendMarkdown(md, md_globals)
+        self.footnotes = FootnoteExtension()
+        self.footnotes.extendMarkdown(md)
+
+        image_cache = None
+        if self.getConfig('image_cache_dir'):
+            image_cache = ImageCache(
+                self.getConfig('image_cache_dir'),
+                max_size=int(self.getConfig('image_cache_size')) * 1024 * 1024)
+        image_fetcher = ImageFetcher(
+            max_workers=int(self.getConfig('image_workers')),
+            timeout=float(self.getConfig('image_timeout')),
+            max_size=int(self.getConfig('image_max_size')) * 1024 * 1024,
+            cache=image_cache)
+        # maths and code are kept here, out of the way of markdown and the
+        # escaping, from the preprocessor or tree processor until the end
+        self.stash = LaTeXStash()
+        math_pp = MathPreprocessor(md, stash=self.stash)
+        longtable_rows = int(self.getConfig('longtable_rows'))
+        latex_tp = LaTeXTreeProcessor(md, image_fetcher=image_fetcher,
+                                      stash=self.stash,
+                                      longtable_rows=longtable_rows,
+                                      footnotes=self.footnotes,
+                                      emitters=self.emitters)
+        # does the work of the unescape_html, math, image, table and link
+        # postprocessors, which can still be registered individually
+        latex_pp = LaTeXTextPostProcessor(md, image_fetcher=image_fetcher,
+                                          stash=self.stash,
+                                          longtable_rows=longtable_rows)
+
+        # after normalize_whitespace, which strips the placeholders' STX and
+        # ETX characters from the text
+        md.preprocessors.register(math_pp, 'latex_math', 25)
+        md.treeprocessors.register(latex_tp, 'latex', 20)
+        md.postprocessors.register(latex_pp, 'latex', 20)
+        md.registerExtension(self)
+        self.image_fetcher = image_fetcher
+        if self.stats is not None:
+            self.stats.attach(md, self)
+
+    def register_emitter(self, tag, emitter):
+        """Convert elements with the given tag with emitter, in place of
+        any emitter for it already. It is called as
+
+            emitter(processor, node, out, start)
+
+        once the LaTeX for the node's content has been appended to the list
+        out, and should wrap or replace what is in out from out[start] on,
+        which is an empty slot kept for the opening markup; see
+        wrap_fragments and replace_fragments, and wrapper and replacer for
+        emitters doing only that. The node's tail is added after. An emitter
+        of None drops the tag, keeping its content. processor.parent is
+        the parent of the node, or None if it is where the walk started, as
+        for a table cell or footnote converted on its own. If the emitter
+        has a true skip_children attribute the node's children are not
+        converted first, and it converts the node whole, as for tables and
+        images. The block cache of an IncrementalConverter does not know about
+        emitters, so give it a new directory after changing them.
+
+            >>> latex_mdx = LaTeXExtension()
+            >>> latex_mdx.register_emitter('del', wrapper('\\sout{', '}'))
+        """
+        if emitter is None:
+            self.emitters.pop(tag, None)
+        else:
+            self.emitters[tag] = emitter
 
-        latex_tp = LaTeXTreeProcessor()
-        math_pp = MathTextPostProcessor()
-        table_pp = TableTextPostProcessor()
-        image_pp = ImageTextPostProcessor()
-        link_pp = LinkTextPostProcessor()
-        unescape_html_pp = UnescapeHtmlTextPostProcessor()
+    def instrument(self, stats=None):
+        """Count the calls, wall time and characters in and out of each
+        stage of conversion, and time the fetching of each remote image, in
+        stats, or a new ConversionStats, and return it. It may be called
+        before or after extendMarkdown; later calls return the same stats.
+        Until it is called nothing is measured, and nothing costs more.
 
-        md.treeprocessors.register(latex_tp, 'latex', 20)
-        md.postprocessors.register(unescape_html_pp, 'unescape_html', 20)
-        md.postprocessors.register(math_pp, 'math', 20)
-        md.postprocessors.register(image_pp, 'image', 20)
-        md.postprocessors.register(table_pp, 'table', 20)
-        md.postprocessors.register(link_pp, 'link', 20)
+            >>> latex_mdx = LaTeXExtension()
+            >>> stats = latex_mdx.instrument()
+        """
+        if self.stats is None:
+            self.stats = stats or ConversionStats()
+            if hasattr(self, 'md'):
+                self.stats.attach(self.md, self)
+        return self.stats
 
     def reset(self):
-        pass
+        if hasattr(self, 'stash'):
+            self.stash.reset()
+            # so that a failed image is tried again, and a changed one
+            # fetched again, for the next document
+            self.image_fetcher.forget()
+
+
+def text_size(value):
+    """Return the number of characters in a string, a list of lines or the
+    text of an element tree."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, list):
+        return sum(map(len, value)) + len(value)
+    if hasattr(value, 'getroot'):
+        value = value.getroot()
+    return sum(len(text) for text in value.itertext())
+
+
+class ConversionStats(object):
+    """The calls, wall time and characters in and out of each stage of
+    conversion by a Markdown instance with a LaTeXExtension, and how long
+    each remote image took to fetch. See LaTeXExtension.instrument.
+
+    The stages are markdown's convert, each preprocessor, the block parser,
+    each treeprocessor and each postprocessor, named like 'tree:latex', and
+    the parts of the LaTeX postprocessor, named like 'post:latex:table'. A
+    stage run from within another, as the inline treeprocessor is for each
+    footnote, counts towards both. While tracemalloc is tracing, the most
+    memory each stage allocated is kept too.
+
+    Stages are timed by replacing the processors' methods with timed ones,
+    so processors registered after the LaTeXExtension was added are not
+    timed. The characters of a tree are those of its text. Converting
+    with LaTeXConverter.fragments or convert_to, the LaTeX postprocessor
+    hands its text on to be converted as it is written out, so neither it
+    nor convert has any characters out, and its parts are counted as the
+    output is written.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # for each stage, in the order they run, a dict of calls, seconds,
+        # chars_in, chars_out and peak (bytes)
+        self.stages = {}
+        # [memory in use at the start, highest peak seen] for each stage
+        # being run, innermost last
+        self.running = []
+        # for each remote image, a dict of its outcome (downloaded,
+        # revalidated, failed), the seconds it took and how many times
+        # it was wanted again once fetched
+        self.images = {}
+
+    def reset(self):
+        """Forget everything measured so far."""
+        with self.lock:
+            for stage in self.stages.values():
+                stage.update(calls=0, seconds=0.0, chars_in=0, chars_out=0,
+                             peak=0)
+            self.images.clear()
+
+    def attach(self, md, extension):
+        """Time the stages of md, which has extension added to it."""
+        self.wrap(md, 'convert', 'convert')
+        self.wrap_registry('pre', md.preprocessors)
+        self.wrap(md.parser, 'parseDocument', 'parse')
+        self.wrap_registry('tree', md.treeprocessors)
+        self.wrap_registry('post', md.postprocessors)
+        latex_pp = md.postprocessors['latex']
+        for processor, attr in (
+                [(latex_pp.unescape_html, 'run'), (latex_pp.math, 'run')] +
+                [(block_pp, 'process_block')
+                 for block_pp in latex_pp.block_processors]):
+            name = type(processor).__name__.replace('TextPostProcessor', '')
+            self.wrap(processor, attr, 'post:latex:%s' % name.lower())
+        extension.image_fetcher.stats = self
+
+    def wrap_registry(self, kind, registry):
+        """Wrap the run method of each processor in registry, as the stage
+        kind:name. A Registry has no public way to list its names, so they
+        are read from _priority, which iterating over it sorts into the
+        order the items run in. Every Markdown 3 release has it; setup.py
+        keeps to those and TestConversionStats checks the names."""
+        items = list(registry)
+        for entry, item in zip(registry._priority, items):
+            self.wrap(item, 'run', '%s:%s' % (kind, entry.name))
+
+    def wrap(self, obj, attr, name):
+        """Replace the method attr of obj, which takes text or a tree and
+        returns text or a tree, or None if it changed the tree in place, by
+        one which counts its calls as the stage name."""
+        func = getattr(obj, attr)
+        stage = self.stages.setdefault(name, {
+            'calls': 0, 'seconds': 0.0, 'chars_in': 0, 'chars_out': 0,
+            'peak': 0})
+
+        def timed(value, *args, **kwargs):
+            chars_in = text_size(value)
+            tracing = tracemalloc.is_tracing()
+            if tracing:
+                self.enter_peak()
+            start = time.perf_counter()
+            try:
+                result = func(value, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                peak = self.leave_peak() if tracing else 0
+            chars_out = text_size(value if result is None else result)
+            with self.lock:
+                stage['calls'] += 1
+                stage['seconds'] += seconds
+                stage['chars_in'] += chars_in
+                stage['chars_out'] += chars_out
+                stage['peak'] = max(stage['peak'], peak)
+            return result
+
+        setattr(obj, attr, timed)
+
+    def enter_peak(self):
+        current, peak = tracemalloc.get_traced_memory()
+        # the stages this one runs within keep the peak so far, as it is
+        # reset for this one
+        for frame in self.running:
+            frame[1] = max(frame[1], peak)
+        tracemalloc.reset_peak()
+        self.running.append([current, current])
+
+    def leave_peak(self):
+        """Return the most memory allocated by the stage just run."""
+        before, peak = self.running.pop()
+        return max(peak, tracemalloc.get_traced_memory()[1]) - before
+
+    def image(self, src):
+        return self.images.setdefault(src, {'outcome': None, 'seconds': 0.0,
+                                            'hits': 0})
+
+    def record_image(self, src, outcome, seconds):
+        """Record that fetching src took seconds, with the given outcome."""
+        with self.lock:
+            self.image(src).update(outcome=outcome, seconds=seconds)
+
+    def record_image_hit(self, src):
+        """Record that src was wanted again once it was fetched, or being
+        fetched."""
+        with self.lock:
+            self.image(src)['hits'] += 1
+
+    def summary(self):
+        """Return a table of the stages and the images fetched."""
+        lines = ['%-28s %8s %10s %12s %12s' % (
+            'stage', 'calls', 'ms', 'chars in', 'chars out')]
+        for name, stage in self.stages.items():
+            if stage['calls']:
+                lines.append('%-28s %8d %10.2f %12d %12d' % (
+                    name, stage['calls'], stage['seconds'] * 1e3,
+                    stage['chars_in'], stage['chars_out']))
+        if self.images:
+            outcomes = collections.Counter(
+                image['outcome'] for image in self.images.values())
+            lines.append('')
+            lines.append('images: %d downloaded, %d revalidated, %d failed, '
+                         '%d hits' % (
+                             outcomes['downloaded'], outcomes['revalidated'],
+                             outcomes['failed'],
+                             sum(image['hits']
+                                 for image in self.images.values())))
+            lines.append('%-50s %12s %10s %6s' % ('image', 'outcome', 'ms',
+                                                  'hits'))
+            for src, image in sorted(self.images.items(),
+                                     key=lambda item: -item[1]['seconds']):
+                lines.append('%-50s %12s %10.2f %6d' % (
+                    src, image['outcome'], image['seconds'] * 1e3,
+                    image['hits']))
+        return '\n'.join(lines)
+
+
+class LaTeXConverter(object):
+    r"""Convert many markdown documents to LaTeX with one set of processors.
+
+    Building a Markdown instance and its processors costs much more than
+    converting a short document, so a converter is built once and then
+    used for every document:
+
+        >>> converter = LaTeXConverter()
+        >>> print(converter.convert('Some *text*'))
+        Some \emph{text}
+
+    The Markdown instance is reset before each document, so nothing from
+    one (reference links, stashed html) leaks into the next. Remote images
+    are fetched once for each document. A converter must
+    only be used by one thread at a time; give each thread its own.
+
+    Keyword arguments are LaTeXExtension config options.
+    """
+
+    def __init__(self, **configs):
+        self.extension = LaTeXExtension(**configs)
+        self.md = markdown.Markdown(extensions=[self.extension])
+
+    def convert(self, text):
+        return self.md.reset().convert(text)
+
+    def fragments(self, text):
+        """Generate the LaTeX for text a block at a time. Joined together
+        and stripped they are what convert() returns.
+
+        Only the last stage, LaTeXTextPostProcessor, goes block by block:
+        markdown converts the whole document before it.
+        """
+        postprocessor = self.md.postprocessors['latex']
+        if list(self.md.postprocessors)[-1] is not postprocessor:
+            # the postprocessors after it need the whole text
+            yield self.convert(text)
+            return
+        postprocessor.held = held = []
+        try:
+            self.md.reset().convert(text)
+        finally:
+            postprocessor.held = None
+        for text in held:
+            yield from postprocessor.fragments(text)
+
+    def convert_to(self, text, fileobj, tmpl=None, **slots):
+        """Write the LaTeX for text to fileobj a block at a time, rather than
+        join it into one string first. If given a Template, or the text of
+        one, tmpl, the LaTeX is written in its text slot, with the other
+        slots filled in from slots.
+        """
+        fragments = iter_stripped(self.fragments(text))
+        if tmpl is None:
+            fileobj.writelines(fragments)
+            return
+        if not isinstance(tmpl, Template):
+            tmpl = Template(tmpl)
+        tmpl.write(fileobj, fragments, **slots)
+
+    def close(self):
+        """Close connections kept alive to image servers."""
+        self.extension.image_fetcher.close()
+
+
+# ===================== INCREMENTAL CONVERSION ===========================
+
+definition_re = re.compile(r'^ {0,3}\[([^\]]+)\]:[ \t]*\S')
+fence_re = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+tabbed_re = re.compile(r'^(\t| {4})')
+list_item_re = re.compile(r'^ {0,3}(?:[*+-]|\d+\.)[ \t]')
+html_block_re = re.compile(r'^<([a-zA-Z][a-zA-Z0-9]*)')
+bracket_re = re.compile(r'\[([^\[\]]+)\]')
+
+
+def reference_id(text):
+    """Normalize the id of a reference link as markdown does."""
+    return ' '.join(text.lower().split())
+
+
+def split_blocks(text):
+    """Split markdown source into its top level blocks, which convert on
+    their own as they do in place, and the lines defining references and
+    footnotes, which may be used from any block.
+
+    Blocks are separated by blank lines, except that these do not end a
+    fenced code block, $$ maths, an html block or a blockquote or list
+    followed by more of the same, and indented lines carry on the block
+    before them, or the footnote definition before them.
+    """
+    blocks = []
+    definitions = []
+    block = []
+    # the first line of the block, once it has one that is not blank
+    first = None
+    fence = None
+    in_math = False
+    html_tag = None
+    blank = False
+    # whether the last definition is a footnote, which indented lines carry
+    # on, and the blank lines since
+    footnote = False
+    blanks = 0
+    for line in text.split('\n'):
+        if fence is not None:
+            block.append(line)
+            if line.strip().startswith(fence):
+                fence = None
+            continue
+        if in_math or html_tag is not None:
+            block.append(line)
+            if '$$' in line and line.count('$$') % 2:
+                in_math = not in_math
+            if html_tag is not None and '</%s>' % html_tag in line:
+                html_tag = None
+            continue
+        if not line or line.isspace():
+            blank = True
+            blanks += 1
+            # markdown makes these empty too
+            block.append('')
+            continue
+        if footnote and tabbed_re.match(line):
+            definitions[-1] += '\n' * (blanks + 1) + line
+            blanks = 0
+            continue
+        footnote = False
+        blanks = 0
+        if blank and first is not None and not line[0].isspace():
+            carries_on = (
+                line[0] == '>' and first[0] == '>' or
+                list_item_re.match(line) and list_item_re.match(first))
+            if not carries_on:
+                blocks.append('\n'.join(block).strip('\n'))
+                block = []
+                first = None
+        blank = False
+        if '[' in line[:4] and definition_re.match(line):
+            definitions.append(line)
+            footnote = definition_re.match(line).group(1).startswith('^')
+            if footnote:
+                # markdown leaves a blank line in place of a footnote
+                blank = True
+            continue
+        if line[0] in '`~ ' and fence_re.match(line):
+            fence = fence_re.match(line).group(1)
+        elif '$$' in line and line.count('$$') % 2:
+            in_math = True
+        elif line[0] == '<' and first is None:
+            match = html_block_re.match(line)
+            if match and '</%s>' % match.group(1) not in line:
+                html_tag = match.group(1)
+        if first is None:
+            first = line
+        block.append(line)
+    if first is not None:
+        blocks.append('\n'.join(block).strip('\n'))
+    return blocks, definitions
+
+
+class BlockCache(object):
+    """The LaTeX for blocks of markdown, by key, for IncrementalConverter.
+
+    Entries are kept in memory and, if a directory is given, on disk as
+    <key>.tex files too, so that they last between runs. At most
+    max_entries are kept in each, dropping the least recently used first.
+    """
+
+    def __init__(self, directory=None, max_entries=10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        # whether there are new files on disk since the last evict
+        self.stored = False
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, key + '.tex')
+        try:
+            with open(path) as fo:
+                latex = fo.read()
+            os.utime(path)
+        except OSError:
+            return None
+        self.remember(key, latex)
+        return latex
+
+    def put(self, key, latex):
+        self.remember(key, latex)
+        if self.directory:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as fo:
+                fo.write(latex)
+            replace_file(tmp, os.path.join(self.directory, key + '.tex'))
+            self.stored = True
+
+    def remember(self, key, latex):
+        self.entries[key] = latex
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def evict(self):
+        """Remove the least recently used files on disk beyond
+        max_entries."""
+        if not self.stored:
+            return
+        self.stored = False
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tex'):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort()
+        for used, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class IncrementalConverter(LaTeXConverter):
+    """A LaTeXConverter which converts a document block by block, reusing
+    the LaTeX of any block it has converted before from a BlockCache.
+
+    A block is looked up by a hash of its source, the definitions of the
+    references and footnotes it uses, which of its footnotes are used
+    before it or more than once, and the config, so after an edit only the
+    changed blocks are converted again. reconverted is the number
+    of blocks converted by the last call to convert.
+
+    The output is that of converting the whole document, but that maths is
+    only looked for within a block.
+    """
+
+    def __init__(self, cache=None, **configs):
+        super().__init__(**configs)
+        self.cache = cache if cache is not None else BlockCache()
+        self.reconverted = 0
+        self.salt = repr(sorted(self.extension.getConfigs().items()))
+        # the source and key of each block of the last document, for as
+        # long as its definitions stay the same
+        self.definitions = None
+        self.keys = {}
+
+    def fragments(self, text):
+        """Generate the LaTeX for text a block at a time."""
+        blocks, definitions = split_blocks(text)
+        if definitions != self.definitions:
+            self.definitions = definitions
+            self.keys = {}
+        by_id = {}
+        footnote_ids = set()
+        for line in definitions:
+            by_id.setdefault(
+                reference_id(definition_re.match(line).group(1)), line)
+            match = FootnoteExtension.DEF_RE.match(line)
+            if match and match.group(2):
+                footnote_ids.add(match.group(2))
+        # the footnotes each block uses, and how many times each footnote
+        # is used in all: a block's LaTeX depends on which of its footnotes
+        # came before it and which are used more than once
+        block_footnotes = [self.footnote_uses(block, footnote_ids)
+                           for block in blocks]
+        footnote_uses = collections.Counter()
+        for ids in block_footnotes:
+            footnote_uses.update(ids)
+        footnotes_before = set()
+        tree_processor = self.md.treeprocessors['latex']
+        postprocessor = self.md.postprocessors['latex']
+        keys = {}
+        self.reconverted = 0
+        for block, ids in zip(blocks, block_footnotes):
+            context = (tuple(sorted(footnotes_before.intersection(ids))),
+                       tuple(sorted(id for id in set(ids)
+                                    if footnote_uses[id] > 1)))
+            footnotes_before.update(ids)
+            if (block, context) in self.keys:
+                source, key = self.keys[block, context]
+            else:
+                # the definitions a block may use are those of anything in
+                # it between brackets
+                used = sorted(set(by_id[ref] for ref in map(
+                    reference_id, bracket_re.findall(block)) if ref in by_id))
+                source = '\n\n'.join([block] + used)
+                key = hashlib.sha1((self.salt + '\0' + repr(context) +
+                                    '\0' + source).encode('utf-8')).hexdigest()
+            keys[block, context] = source, key
+            latex = self.cache.get(key)
+            if latex is None:
+                tree_processor.footnotes_before = context[0]
+                tree_processor.footnote_uses = footnote_uses
+                try:
+                    latex = super().convert(source)
+                finally:
+                    tree_processor.footnotes_before = ()
+                    tree_processor.footnote_uses = None
+                # put back the whitespace markdown strips, after the tree
+                # processor and before the postprocessor, which is what
+                # separates the block from its neighbours in the document
+                latex = (tree_processor.margins[0] + postprocessor.margins[0]
+                         + latex + postprocessor.margins[1]
+                         + tree_processor.margins[1])
+                self.cache.put(key, latex)
+                self.reconverted += 1
+            yield latex
+        self.keys = keys
+        if self.cache.directory:
+            self.cache.evict()
+
+    def footnote_uses(self, block, footnote_ids):
+        """Return the ids of the footnotes used in block, in order."""
+        if '[^' not in block:
+            return []
+        return [id for id in map(str.strip,
+                                 FootnoteExtension.SHORT_USE_RE.findall(block))
+                if id in footnote_ids]
+
+    def convert(self, text):
+        return ''.join(self.fragments(text)).strip()
+
+
+def strip_fragments(out, start=0):
+    """Strip out[start:] in place as str.strip() would strip their
+    concatenation, without building it."""
+    end = len(out)
+    while start < end:
+        out[start] = out[start].lstrip()
+        if out[start]:
+            break
+        start += 1
+    while end > start:
+        end -= 1
+        out[end] = out[end].rstrip()
+        if out[end]:
+            break
+
+
+def wrap_fragments(out, start, prefix, suffix, strip=False):
+    """Surround the fragments in out since start with prefix and suffix,
+    first stripping them as a whole if strip is set. out[start] is the slot
+    kept for the prefix."""
+    if strip:
+        strip_fragments(out, start + 1)
+    out[start] = prefix
+    out.append(suffix)
+
+
+def replace_fragments(out, start, text):
+    """Discard the fragments in out since start in favour of text."""
+    del out[start + 1:]
+    out[start] = text
+
+
+def wrapper(prefix, suffix, strip=False):
+    """Return an emitter for LaTeXTreeProcessor surrounding the LaTeX for
+    the content of a node with prefix and suffix, as by wrap_fragments."""
+    def emitter(processor, ournode, out, start):
+        wrap_fragments(out, start, prefix, suffix, strip)
+    return emitter
+
+
+def replacer(text):
+    """Return an emitter for LaTeXTreeProcessor putting text in place of a
+    node and its content."""
+    def emitter(processor, ournode, out, start):
+        replace_fragments(out, start, text)
+    # the content is thrown away, so it need not be converted
+    emitter.skip_children = True
+    return emitter
 
 
 class LaTeXTreeProcessor(markdown.treeprocessors.Treeprocessor):
+    def __init__(self, md=None, image_fetcher=None, stash=None,
+                 longtable_rows=0, footnotes=None, emitters=None):
+        super().__init__(md)
+        # tags without an emitter are left out, but not their content
+        self.emitters = (self.default_emitters if emitters is None
+                         else emitters)
+        self.image_fetcher = image_fetcher or ImageFetcher()
+        # if given, code is put in it so the postprocessors leave it alone
+        self.stash = stash
+        self.longtable_rows = longtable_rows
+        # the FootnoteExtension the footnotes in the tree come from
+        self.footnotes = footnotes
+        # the footnotes already output in this document
+        self.footnotes_done = set()
+        # when the tree is only part of a document, as for
+        # IncrementalConverter, the footnotes output before it and how many
+        # times each footnote is used in the whole document
+        self.footnotes_before = ()
+        self.footnote_uses = None
+        # the parent of the node being closed, if known
+        self.parent = None
+        # the whitespace before and after the LaTeX of the last tree, which
+        # markdown strips off
+        self.margins = ('', '')
+
     def run(self, doc):
         """Walk the dom converting relevant nodes to text nodes with relevant
         content."""
+        # download all the remote images up front, possibly in parallel
+        self.image_fetcher.prefetch(img.get('src', '')
+                                    for img in doc.iter('img'))
+        self.footnotes_done = set(self.footnotes_before)
         latex_text = self.tolatex(doc)
+        self.margins = margins(latex_text)
 
+        # the text goes straight in the document element, which markdown
+        # strips off when serializing
         doc.clear()
-        latex_node = etree.Element('root')
-        latex_node.text = latex_text
-        doc.append(latex_node)
+        doc.text = latex_text
 
     def tolatex(self, ournode):
-        buffer = ""
-        subcontent = ""
+        """Return the LaTeX for ournode, its descendants and its tail.
 
-        if ournode.text:
-            subcontent += escape_latex_entities(ournode.text)
+        Every node writes its fragments into one shared list which is joined
+        once at the end, so the cost is linear in the size of the tree rather
+        than in its size times its depth.
+        """
+        out = []
+        self.emit(ournode, out)
+        return ''.join(out)
+
+    def emit(self, ournode, out):
+        """Append the LaTeX fragments for ournode to the list out."""
+        starts = []
+        parents = []
+
+        def enter(node):
+            parents.append(node)
+            # reserve a slot for the opening markup: what goes there may
+            # only be known once the children have been emitted
+            starts.append(len(out))
+            out.append('')
+            # some are converted whole when they are left
+            if getattr(self.emitters.get(node.tag), 'skip_children', False):
+                return False
+            if node.tag == 'pre' and self.stash is not None:
+                # verbatim, so neither escaped nor postprocessed
+                text = unescape_html_entities(''.join(node.itertext()))
+                out.append(self.stash.store(text.strip()))
+                return False
+            if node.text:
+                text = escape_latex_entities(node.text)
+                if node.tag == 'code' and self.stash is not None:
+                    text = self.stash.store(text)
+                out.append(text)
+
+        def leave(node):
+            parents.pop()
+            self.parent = parents[-1] if parents else None
+            self.close(node, out, starts.pop())
+
+        walk(ournode, enter, leave)
+
+    def close(self, ournode, out, start):
+        """Wrap up the fragments emitted for ournode since start, once all of
+        its children have been emitted, with the emitter for its tag."""
+        emitter = self.emitters.get(ournode.tag)
+        if emitter is not None:
+            emitter(self, ournode, out, start)
+        if ournode.tail:
+            out.append(escape_latex_entities(ournode.tail))
+
+    def close_ol(self, ournode, out, start):
+        prefix = """
+\\begin{enumerate}"""
+        if 'start' in ournode.attrib.keys():
+            start_at = int(ournode.attrib['start'])-1
+            prefix += "\setcounter{enumi}{"+str(start_at)+"}"
+        # no need for leading \n as one will be provided by li
+        wrap_fragments(out, start, prefix + '\n', """
+\\end{enumerate}
+""")
+
+    def close_sup(self, ournode, out, start):
+        if ournode.get('footnote') is not None:
+            replace_fragments(out, start, self.footnote_latex(
+                ournode.get('footnote')))
+        else:
+            # Footnote processor inserts all of the footnote in a sup tag
+            wrap_fragments(out, start, '\\footnote{', '}', strip=True)
+
+    def close_table(self, ournode, out, start):
+        table = Table2Latex(self.longtable_rows).convert_element(
+            ournode, self.content_latex)
+        replace_fragments(out, start, '\n\n%s\n\n' % table.strip())
+
+    close_table.skip_children = True
+
+    def close_img(self, ournode, out, start):
+        # a figure only when the image is a paragraph of its own, as a
+        # float is not allowed inside a link, emphasis or table
+        parent = self.parent
+        inline = (parent is None or parent.tag != 'p' or len(parent) > 1
+                  or (parent.text or '').strip()
+                  or (ournode.tail or '').strip())
+        img = Img2Latex(self.image_fetcher).convert_element(ournode,
+                                                            bool(inline))
+        replace_fragments(out, start, img.strip())
+
+    close_img.skip_children = True
+
+    def close_a(self, ournode, out, start):
+        href = escape_latex_entities(ournode.get('href', ''))
+        if len(ournode):
+            wrap_fragments(out, start, '\\href{%s}{' % href, '}')
+        else:
+            desc = ''.join(out[start + 1:])
+            replace_fragments(out, start, Link2Latex().format(href, desc))
 
-        if list(ournode):
-            for child in list(ournode):
-                subcontent += self.tolatex(child)
+    # the emitter for each tag, called as emitter(processor, node, out,
+    # start) once the node and its children have been emitted
+    default_emitters = {
+        'h1': wrapper('\n\\title{', """}
 
-        if ournode.tag == 'h1':
-            buffer += '\n\\title{%s}\n' % subcontent
-            buffer += """
 % ----------------------------------------------------------------
 \maketitle
 % ----------------------------------------------------------------
-"""
-        elif ournode.tag == 'h2':
-            buffer += '\n\n\\section{%s}\n' % subcontent
-        elif ournode.tag == 'h3':
-            buffer += '\n\n\\subsection{%s}\n' % subcontent
-        elif ournode.tag == 'h4':
-            buffer += '\n\\subsubsection{%s}\n' % subcontent
-        elif ournode.tag == 'hr':
-            buffer += '\\noindent\makebox[\linewidth]{\\rule{\linewidth}{0.4pt}}'
-        elif ournode.tag == 'ul':
-            # no need for leading \n as one will be provided by li
-            buffer += """
-\\begin{itemize}%s
+"""),
+        'h2': wrapper('\n\n\\section{', '}\n'),
+        'h3': wrapper('\n\n\\subsection{', '}\n'),
+        'h4': wrapper('\n\\subsubsection{', '}\n'),
+        'hr': replacer(
+            '\\noindent\makebox[\linewidth]{\\rule{\linewidth}{0.4pt}}'),
+        # no need for leading \n as one will be provided by li
+        'ul': wrapper("""
+\\begin{itemize}""", """
 \\end{itemize}
-""" % subcontent
-        elif ournode.tag == 'ol':
-            buffer += """
-\\begin{enumerate}"""            
-            if 'start' in ournode.attrib.keys():
-                start = int(ournode.attrib['start'])-1
-                buffer += "\setcounter{enumi}{"+str(start)+"}"
-            # no need for leading \n as one will be provided by li
-            buffer += """
-%s
-\\end{enumerate}
-""" % subcontent
-        elif ournode.tag == 'li':
-            buffer += """
-  \\item %s""" % subcontent.strip()
-        elif ournode.tag == 'blockquote':
-            # use quotation rather than quote as quotation can support multiple
-            # paragraphs
-            buffer += """
+"""),
+        'ol': close_ol,
+        'li': wrapper("""
+  \\item """, '', strip=True),
+        # use quotation rather than quote as quotation can support multiple
+        # paragraphs
+        'blockquote': wrapper("""
 \\begin{quotation}
-%s
+""", """
 \\end{quotation}
-""" % subcontent.strip()
+""", strip=True),
         # ignore 'code' when inside pre tags
         # (mkdn produces <pre><code></code></pre>)
-        elif (ournode.tag == 'pre' or
-                             # TODO: Take a look here
-             (ournode.tag == 'pre' and ournode.parentNode.tag != 'pre')):
-            buffer += """
+        'pre': wrapper("""
 \\begin{verbatim}
-%s
+""", """
 \\end{verbatim}
-""" % subcontent.strip()
-        elif ournode.tag == 'q':
-            buffer += "`%s'" % subcontent.strip()
-        elif ournode.tag == 'p':
-            buffer += '\n%s\n' % subcontent.strip()
-        # Footnote processor inserts all of the footnote in a sup tag
-        elif ournode.tag == 'sup':
-            buffer += '\\footnote{%s}' % subcontent.strip()
-        elif ournode.tag == 'strong':
-            buffer += '\\textbf{%s}' % subcontent.strip()
-        elif ournode.tag == 'em':
-            buffer += '\\emph{%s}' % subcontent.strip()
-        # Keep table strcuture. TableTextPostProcessor will take care.
-        elif ournode.tag == 'table':
-            buffer += '\n\n<table>%s</table>\n\n' % subcontent
-        elif ournode.tag == 'thead':
-            buffer += '<thead>%s</thead>' % subcontent
-        elif ournode.tag == 'tbody':
-            buffer += '<tbody>%s</tbody>' % subcontent
-        elif ournode.tag == 'tr':
-            buffer += '<tr>%s</tr>' % subcontent
-        elif ournode.tag == 'th':
-            buffer += '<th>%s</th>' % subcontent
-        elif ournode.tag == 'td':
-            buffer += '<td>%s</td>' % subcontent
-        elif ournode.tag == 'img':
-            buffer += '<img src=\"%s\" alt=\"%s\" />' % (ournode.get('src'),
-                      ournode.get('alt'))
-        elif ournode.tag == 'a':
-            buffer += '<a href=\"%s\">%s</a>' % (escape_latex_entities(ournode.get('href')),
-                      subcontent)
-        else:
-            buffer = subcontent
-
-        if ournode.tail:
-            buffer += escape_latex_entities(ournode.tail)
-
-        return buffer
+""", strip=True),
+        'q': wrapper("`", "'", strip=True),
+        'p': wrapper('\n', '\n', strip=True),
+        'sup': close_sup,
+        'strong': wrapper('\\textbf{', '}', strip=True),
+        'em': wrapper('\\emph{', '}', strip=True),
+        'table': close_table,
+        'img': close_img,
+        'a': close_a,
+    }
+
+    def footnote_latex(self, id):
+        """Return the LaTeX for a use of footnote id: the footnote itself
+        the first time, and a mark with its number after that (\\footref
+        is in LaTeX from 2021; older ones need the footmisc package)."""
+        label = 'fn:' + re.sub(r'[^A-Za-z0-9.:-]', '-', id)
+        if id in self.footnotes_done:
+            return '\\footref{%s}' % label
+        self.footnotes_done.add(id)
+        text = self.content_latex(self.footnotes.footnoteElement(id)).strip()
+        uses = self.footnote_uses or self.footnotes.use_counts
+        if uses[id] > 1:
+            # for the marks to refer to
+            text = '\\label{%s}%s' % (label, text)
+        return '\\footnote{%s}' % text
+
+    def content_latex(self, ournode):
+        """Return the LaTeX for the text and children of ournode, without
+        its own markup or tail."""
+        out = []
+        if ournode.text:
+            out.append(escape_latex_entities(ournode.text))
+        for child in ournode:
+            self.emit(child, out)
+        return ''.join(out)
 
 
 class UnescapeHtmlTextPostProcessor(markdown.postprocessors.Postprocessor):
@@ -230,11 +1137,106 @@ class UnescapeHtmlTextPostProcessor(markdown.postprocessors.Postprocessor):
     def run(self, text):
         return unescape_html_entities(inline_html_latex(text))
 
+# ===================== ALL TEXT POSTPROCESSING ===========================
+
+class LaTeXTextPostProcessor(markdown.postprocessors.Postprocessor):
+    """Do the work of UnescapeHtmlTextPostProcessor, MathTextPostProcessor,
+    ImageTextPostProcessor, TableTextPostProcessor and LinkTextPostProcessor,
+    in that order, in one stage.
+
+    Html unescaping and maths run over the whole text, as quote and dollar
+    pairs may span blocks. The text is then split into blocks only once and
+    each block is handed to whichever of the image, table and link
+    converters it needs.
+    """
+
+    def __init__(self, md=None, image_fetcher=None, stash=None,
+                 longtable_rows=0):
+        super().__init__(md)
+        # if given, what is in it is put back in the text at the end
+        self.stash = stash
+        # if a list, run() appends its text to it and returns nothing, for
+        # LaTeXConverter.fragments to convert it block by block
+        self.held = None
+        self.margins = ('', '')
+        self.unescape_html = UnescapeHtmlTextPostProcessor(md)
+        self.math = MathTextPostProcessor(md)
+        self.image = ImageTextPostProcessor(md, image_fetcher)
+        # these work block by block, each on the output of the one before
+        self.block_processors = [
+            self.image,
+            TableTextPostProcessor(md, longtable_rows),
+            LinkTextPostProcessor(md),
+        ]
+
+    def run(self, text):
+        # the whitespace markdown strips off the result
+        self.margins = margins(text)
+        if self.held is not None:
+            self.held.append(text)
+            return ''
+        return ''.join(self.fragments(text))
+
+    def fragments(self, text):
+        """Generate the converted text a block at a time, with the blank
+        lines between blocks as separate fragments."""
+        text = self.math.run(self.unescape_html.run(text))
+        blocks = text.split('\n\n')
+        self.image.prefetch(blocks)
+        first = True
+        # (index of next block processor, block), last block on top
+        pending = [(0, block) for block in reversed(blocks)]
+        del blocks, text
+        while pending:
+            index, block = pending.pop()
+            # all the converters look for html tags
+            if '<' in block:
+                block = self.process_block(index, block, pending)
+                if block is None:
+                    continue
+            if not first:
+                yield '\n\n'
+            yield self.restore(block)
+            first = False
+
+    def process_block(self, index, block, pending):
+        """Run block through the block processors from index on. If one of
+        them splits it, push the new blocks onto pending and return None."""
+        # the converters parse html, which the placeholders would make
+        # invalid
+        block = self.restore(block)
+        for index in range(index, len(self.block_processors)):
+            new_block = self.block_processors[index].process_block(block)
+            if new_block is not block and '\n\n' in new_block:
+                # the processors after this one would see several blocks
+                pending.extend((index + 1, sub_block) for sub_block in
+                               reversed(new_block.split('\n\n')))
+                return None
+            block = new_block
+        return block
+
+    def restore(self, text):
+        if self.stash is not None:
+            text = self.stash.restore(text)
+        return text
+
+
 # ========================= MATHS =================================
 
 
 class MathTextPostProcessor(markdown.postprocessors.Postprocessor):
 
+    # all the $$...$$ are found first, and then the $...$ between them, so
+    # that a lone dollar cannot pair with one of a later $$
+    block_re = re.compile(r'\$\$([^$]*)\$\$')
+    inline_re = re.compile(r'\$([^$]*)\$')
+    # some extras due to asciimathml, made inside maths only
+    asciimath_fixes = [
+        ('\\lt', '<'),
+        (' * ', ' \\cdot '),
+        ('\\del', '\\partial'),
+    ]
+
     def run(self, instr):
         """Convert all math sections in {text} whether latex, asciimathml or
         latexmathml formatted to latex.
@@ -243,31 +1245,169 @@ class MathTextPostProcessor(markdown.postprocessors.Postprocessor):
         mathematics delimiter (*not* the standard asciimathml or latexmathml
         delimiter).
         """
-        def repl_1(matchobj):
-            text = unescape_latex_entities(matchobj.group(1))
-            return '\\[%s\\]' % text
-
-        def repl_2(matchobj):
-            text = unescape_latex_entities(matchobj.group(1))
-            return '\\(%s\\)' % text
-
-        # This $$x=3$$ is block math
-        pat = re.compile('\$\$([^\$]*)\$\$')
-        out = pat.sub(repl_1, instr)
-        # This $x=3$ is inline math
-        pat2 = re.compile('\$([^\$]*)\$')
-        out = pat2.sub(repl_2, out)
-        # some extras due to asciimathml
-        out = out.replace('\\lt', '<')
-        out = out.replace(' * ', ' \\cdot ')
-        out = out.replace('\\del', '\\partial')
-        return out
+        if '$' not in instr:
+            return instr
+        out = []
+        # the index in out of each piece of maths, and its delimiters
+        maths = []
+        # text, block, text, block, ..., text
+        for index, part in enumerate(self.block_re.split(instr)):
+            if index % 2:
+                # This $$x=3$$ is block math
+                maths.append((len(out), '\\[%s\\]'))
+                out.append(part)
+                continue
+            # text, inline, text, inline, ..., text
+            for index, part in enumerate(self.inline_re.split(part)):
+                if index % 2:
+                    # This $x=3$ is inline math
+                    maths.append((len(out), '\\(%s\\)'))
+                out.append(part)
+        # math can't contain dollars, so all of it can be fixed up at once
+        # joined by them
+        fixed = self.fix_asciimath(unescape_latex_entities(
+            '$'.join([out[index] for index, _ in maths]))).split('$')
+        for (index, delimiters), math in zip(maths, fixed):
+            out[index] = delimiters % math
+        return ''.join(out)
+
+    def fix_asciimath(self, maths):
+        for old, new in self.asciimath_fixes:
+            maths = maths.replace(old, new)
+        return maths
+
+
+class MathPreprocessor(markdown.preprocessors.Preprocessor):
+    """Convert maths before markdown parses the text, and put it in a
+    LaTeXStash.
+
+    The maths is left in the text as placeholders, so neither markdown nor
+    the escaping and postprocessing touch it, and LaTeXTextPostProcessor
+    puts it back verbatim at the end. Dollars in code are not maths:
+    fenced code, code spans and indented code blocks are skipped.
+    """
+
+    code_re = r'''
+        ( (`+).*?(?<!`)\2(?!`)               # a code span
+        )'''
+    # block maths is stashed before inline maths is looked for, and inline
+    # maths cannot run over a placeholder, so as with
+    # MathTextPostProcessor a lone dollar cannot pair with one of a $$
+    block_re = re.compile(r'(?mx)' + code_re + r'''
+        | \$\$([^$]*)\$\$                      # block maths
+        ''')
+    inline_re = re.compile(r'(?mx)' + code_re + r'''
+        | \$([^$\x02]*)\$                       # inline maths
+        ''')
+
+    def __init__(self, md=None, stash=None):
+        super().__init__(md)
+        self.stash = stash if stash is not None else LaTeXStash()
+        self.math = MathTextPostProcessor(md)
+
+    def run(self, lines):
+        if not any('$' in line for line in lines):
+            return lines
+        chunks = []
+        for is_code, chunk in self.split_code(lines):
+            chunk = '\n'.join(chunk)
+            if not is_code and '$' in chunk:
+                if '$$' in chunk:
+                    chunk = self.block_re.sub(self.replace_block, chunk)
+                if '$' in chunk:
+                    chunk = self.inline_re.sub(self.replace_inline, chunk)
+            chunks.append(chunk)
+        return '\n'.join(chunks).split('\n')
+
+    def split_code(self, lines):
+        """Generate (is_code, lines) for the runs of lines that are, or are
+        not, fenced or indented code blocks.
+
+        As for markdown, indented lines are only code after a blank line,
+        and not when they carry on a list item.
+        """
+        run = []
+        run_is_code = False
+        fence = None
+        in_code = False
+        in_list = False
+        blank = True
+        for line in lines:
+            if fence is not None:
+                is_code = True
+                if line.strip().startswith(fence):
+                    fence = None
+            elif not line.strip():
+                # blank lines are in an indented code block if more of it
+                # follows, and do not matter if not
+                is_code = run_is_code
+                blank = True
+            elif tabbed_re.match(line):
+                in_code = is_code = in_code or (blank and not in_list)
+                blank = False
+            else:
+                is_list_item = bool(list_item_re.match(line))
+                in_list = is_list_item or (in_list and not blank)
+                in_code = blank = False
+                match = fence_re.match(line)
+                is_code = match is not None
+                if is_code:
+                    fence = match.group(1)
+            if is_code != run_is_code and run:
+                yield run_is_code, run
+                run = []
+            run_is_code = is_code
+            run.append(line)
+        if run:
+            yield run_is_code, run
+
+    def replace_block(self, matchobj):
+        if matchobj.group(1) is not None:
+            return matchobj.group(1)
+        return self.stash.store(
+            '\\[%s\\]' % self.math.fix_asciimath(matchobj.group(3)))
+
+    def replace_inline(self, matchobj):
+        if matchobj.group(1) is not None:
+            return matchobj.group(1)
+        return self.stash.store(
+            '\\(%s\\)' % self.math.fix_asciimath(matchobj.group(3)))
+
+
+class LaTeXStash(object):
+    """Text put aside, with a placeholder left in its place, until the
+    LaTeX is otherwise done."""
+
+    placeholder = '\x02latex:%d\x03'
+    placeholder_re = re.compile('\x02latex:(\\d+)\x03')
+
+    def __init__(self):
+        self.texts = []
+
+    def store(self, text):
+        """Put text aside and return its placeholder."""
+        self.texts.append(text)
+        return self.placeholder % (len(self.texts) - 1)
+
+    def restore(self, text):
+        """Return text with the placeholders replaced by what they hold."""
+        if '\x02' not in text:
+            return text
+        return self.placeholder_re.sub(
+            lambda m: self.texts[int(m.group(1))], text)
+
+    def reset(self):
+        self.texts = []
 
 
 # ========================= TABLES =================================
 
 class TableTextPostProcessor(markdown.postprocessors.Postprocessor):
 
+    def __init__(self, md=None, longtable_rows=0):
+        super().__init__(md)
+        self.longtable_rows = longtable_rows
+
     def run(self, instr):
         """This is not very sophisticated and for it to work it is expected
         that:
@@ -275,53 +1415,70 @@ class TableTextPostProcessor(markdown.postprocessors.Postprocessor):
             blank line above and below)
             2. no nesting of tables
         """
-        converter = Table2Latex()
-        new_blocks = []
-
-        for block in instr.split('\n\n'):
-            stripped = block.strip()
-            # <table catches modified verions (e.g. <table class="..">
-            if stripped.startswith('<table') and stripped.endswith('</table>'):
-                latex_table = converter.convert(stripped).strip()
-                new_blocks.append(latex_table)
-            else:
-                new_blocks.append(block)
-        return '\n\n'.join(new_blocks)
+        return '\n\n'.join(self.process_block(block)
+                            for block in instr.split('\n\n'))
+
+    def process_block(self, block):
+        stripped = block.strip()
+        # <table catches modified verions (e.g. <table class="..">
+        if stripped.startswith('<table') and stripped.endswith('</table>'):
+            try:
+                return Table2Latex(self.longtable_rows).convert(
+                    escape_bare_ampersands(stripped)).strip()
+            except etree.ParseError:
+                # such as a <br> or a < in a cell, left as it is
+                pass
+        return block
 
 
 class Table2Latex:
     """
-    Convert html tables to Latex.
+    Convert html tables to Latex, either from their html source (convert) or
+    from an ElementTree table element (convert_element).
+
+    Tables with more than longtable_rows rows (if it is not 0) are output
+    as a longtable, which can break across pages, with the rows in thead
+    repeated at the top of each page. This needs the longtable package.
 
     TODO: escape latex entities.
     """
 
+    # characters of html source parsed at a time by convert
+    chunk_size = 64 * 1024
+
+    def __init__(self, longtable_rows=0):
+        self.longtable_rows = longtable_rows
+
     def colformat(self):
         # centre align everything by default
         out = '|l' * self.maxcols + '|'
         return out
 
-    def get_text(self, element):
-        if element.nodeType == element.TEXT_NODE:
-            return escape_latex_entities(element.data)
-        result = ''
-        if element.childNodes:
-            for child in element.childNodes:
-                text = self.get_text(child)
-                if text.strip() != '':
-                    result += text
-        return result
-
-    def process_cell(self, element):
-        # works on both td and th
-        colspan = 1
-        subcontent = self.get_text(element)
+    def element_text(self, element):
+        """Return the escaped text in element and its descendants, leaving
+        out the pieces that are only whitespace."""
+        pieces = []
+
+        def enter(node):
+            if node.text and node.text.strip() != '':
+                pieces.append(escape_latex_entities(node.text))
+
+        def leave(node):
+            if node is not element and node.tail and node.tail.strip() != '':
+                pieces.append(escape_latex_entities(node.tail))
+
+        walk(element, enter, leave)
+        return ''.join(pieces)
+
+    def cell_latex(self, tag, colspan, subcontent, notLast):
+        """Return the latex for a td or th cell, where colspan is the value
+        of its colspan attribute, if any."""
         buffer = ""
 
-        if element.tagName == 'th':
+        if tag == 'th':
             subcontent = '\\textbf{%s}' % subcontent
-        if element.hasAttribute('colspan'):
-            colspan = int(element.getAttribute('colspan'))
+        if colspan is not None:
+            colspan = int(colspan)
             buffer += ' \multicolumn{%s}{|c|}{%s}' % (colspan, subcontent)
         # we don't support rowspan because:
         #   1. it needs an extra latex package \usepackage{multirow}
@@ -334,55 +1491,170 @@ class Table2Latex:
         else:
             buffer += ' %s' % subcontent
 
-        notLast = (element.nextSibling.nextSibling and
-                   element.nextSibling.nextSibling.nodeType ==
-                   element.ELEMENT_NODE and
-                   element.nextSibling.nextSibling.tagName in ['td', 'th'])
-
         if notLast:
             buffer += ' &'
 
-        self.numcols += colspan
+        self.numcols += colspan or 1
         return buffer
 
-    def tolatex(self, element):
-        if element.nodeType == element.TEXT_NODE:
-            return ""
+    def element_tolatex(self, element, cell_text):
+        """Like tolatex, for an ElementTree element, with the content of each
+        cell given by cell_text(cell)."""
+        results = [[]]
+        # cells followed by another cell, which get a trailing &
+        notLast = set()
+        in_head = [0]
+
+        def enter(node):
+            results.append([])
+            if node.tag in ('td', 'th'):
+                return False
+            if node.tag == 'thead':
+                in_head[0] += 1
+            children = list(node)
+            for child, next_child in zip(children, children[1:]):
+                if next_child.tag in ('td', 'th'):
+                    notLast.add(child)
+
+        def leave(node):
+            kids = results.pop()
+            if node.tag in ('td', 'th'):
+                results[-1].append(self.cell_latex(
+                    node.tag, node.get('colspan'), cell_text(node),
+                    node in notLast))
+                return
+
+            subcontent = ''.join(kid for kid in kids if kid.strip() != "")
+            subcontent = subcontent.strip()
+            if node.tag == 'tr':
+                results[-1].append(self.end_row(subcontent, in_head[0]))
+            else:
+                if node.tag == 'thead':
+                    in_head[0] -= 1
+                results[-1].append(subcontent)
 
-        buffer = ""
-        subcontent = ""
-        if element.childNodes:
-            for child in element.childNodes:
-                text = self.tolatex(child)
-                if text.strip() != "":
-                    subcontent += text
-        subcontent = subcontent.strip()
-
-        if element.tagName == 'thead':
-            buffer += subcontent
-
-        elif element.tagName == 'tr':
-            self.maxcols = max(self.numcols, self.maxcols)
-            self.numcols = 0
-            buffer += '\n\\hline\n%s \\\\' % subcontent
-
-        elif element.tagName == 'td' or element.tagName == 'th':
-            buffer = self.process_cell(element)
-        else:
-            buffer += subcontent
-        return buffer
+        walk(element, enter, leave)
+        return results[0][0]
 
-    def convert(self, instr):
-        self.numcols = 0
-        self.maxcols = 0
-        dom = xml.dom.minidom.parseString(instr)
-        core = self.tolatex(dom.documentElement)
+    def convert_element(self, element, cell_text=None):
+        """Convert an ElementTree table element.
+
+        cell_text(cell) gives the latex for the content of a td or th element
+        and defaults to its escaped text.
+        """
+        self.start_table()
+        core = self.element_tolatex(element, cell_text or self.element_text)
 
-        captionElements = dom.documentElement.getElementsByTagName('caption')
         caption = ''
-        if captionElements:
-            caption = self.get_text(captionElements[0])
+        caption_element = next(element.iter('caption'), None)
+        if caption_element is not None:
+            caption = self.element_text(caption_element)
+        return self.table_latex(core, caption)
+
+    def convert(self, instr):
+        """Convert the html source of a table.
 
+        The source is parsed a chunk at a time and each element is dropped
+        from the tree once it has been converted, so that even a table with
+        very many rows never needs more than a row of it in memory.
+        """
+        self.start_table()
+        # the open elements outside cells, and for each one the latex of its
+        # children so far and the index in that of a cell followed by nothing
+        # but text yet, which gets a trailing & if another cell follows
+        elements = []
+        results = [[]]
+        pending = [None]
+        # the cell being read, whose content is converted whole at its end
+        cell = None
+        caption_element = None
+        caption = None
+        in_head = 0
+
+        def start(node):
+            nonlocal cell, caption_element, in_head
+            if caption_element is None and node.tag == 'caption':
+                caption_element = node
+            if cell is not None:
+                return
+            if node.tag == 'thead':
+                in_head += 1
+            if pending[-1] is not None and node.tag in ('td', 'th'):
+                results[-1][pending[-1]] += ' &'
+            pending[-1] = None
+            if node.tag in ('td', 'th'):
+                cell = node
+                return
+            elements.append(node)
+            results.append([])
+            pending.append(None)
+
+        def end(node):
+            nonlocal cell, caption, in_head
+            if node is caption_element:
+                caption = self.element_text(node)
+            if cell is not None:
+                if node is not cell:
+                    return
+                cell = None
+                results[-1].append(self.cell_latex(
+                    node.tag, node.get('colspan'), self.element_text(node),
+                    False))
+                pending[-1] = len(results[-1]) - 1
+            else:
+                elements.pop()
+                pending.pop()
+                kids = results.pop()
+                subcontent = ''.join(kid for kid in kids if kid.strip() != "")
+                subcontent = subcontent.strip()
+                if node.tag == 'tr':
+                    subcontent = self.end_row(subcontent, in_head)
+                elif node.tag == 'thead':
+                    in_head -= 1
+                results[-1].append(subcontent)
+            # done with, so let it go, unless it is needed for the caption
+            if elements and (caption_element is None or caption is not None):
+                elements[-1].remove(node)
+
+        def handle(events):
+            for event, node in events:
+                if event == 'start':
+                    start(node)
+                else:
+                    end(node)
+
+        parser = etree.XMLPullParser(events=('start', 'end'))
+        for offset in range(0, len(instr), self.chunk_size):
+            parser.feed(instr[offset:offset + self.chunk_size])
+            handle(parser.read_events())
+        parser.close()
+        handle(parser.read_events())
+        return self.table_latex(results[0][0], caption or '')
+
+    def start_table(self):
+        self.numcols = 0
+        self.maxcols = 0
+        # the latex of the rows, for a longtable
+        self.head_rows = []
+        self.body_rows = []
+
+    def end_row(self, subcontent, in_head):
+        """Return the latex for a row, given that for its cells, and note
+        it down as a head or body row."""
+        self.maxcols = max(self.numcols, self.maxcols)
+        self.numcols = 0
+        row = '\n\\hline\n%s \\\\' % subcontent
+        if in_head:
+            self.head_rows.append(row)
+        else:
+            self.body_rows.append(row)
+        return row
+
+    def table_latex(self, core, caption):
+        if (self.longtable_rows and
+                len(self.head_rows) + len(self.body_rows) >
+                self.longtable_rows):
+            return self.longtable_latex(caption)
         colformatting = self.colformat()
         table_latex = \
             """
@@ -397,11 +1669,38 @@ class Table2Latex:
             """ % (colformatting, core, caption)
         return table_latex
 
+    def longtable_latex(self, caption):
+        """Return a longtable of the rows, with the head rows at the top of
+        every page."""
+        # every row starts with a rule, so the head needs none below it
+        head = ''.join(self.head_rows).strip()
+        if head:
+            head += '\n'
+        longtable_latex = \
+            """
+\\begin{longtable}{%s}
+\\caption{%s} \\\\
+%s\\endfirsthead
+\\caption[]{%s} \\\\
+%s\\endhead
+%s
+\\hline
+\\end{longtable}
+""" % (self.colformat(), caption, head, caption, head,
+       ''.join(self.body_rows).strip())
+        return longtable_latex
+
 
 # ========================= IMAGES =================================
 
 class ImageTextPostProcessor(markdown.postprocessors.Postprocessor):
 
+    src_re = re.compile(r'\ssrc="([^"]*)"')
+
+    def __init__(self, md=None, image_fetcher=None):
+        super().__init__(md)
+        self.image_fetcher = image_fetcher or ImageFetcher()
+
     def run(self, instr):
         """Process all img tags
 
@@ -409,37 +1708,402 @@ class ImageTextPostProcessor(markdown.postprocessors.Postprocessor):
         to work it is expected that img tags are put in a section of their own
         (that is separated by at least one blank line above and below).
         """
-        converter = Img2Latex()
-        new_blocks = []
-        for block in instr.split("\n\n"):
-            stripped = block.strip()
-            # <table catches modified verions (e.g. <table class="..">
-            if stripped.startswith('<img'):
-                latex_img = converter.convert(stripped).strip()
-                new_blocks.append(latex_img)
+        blocks = instr.split('\n\n')
+        self.prefetch(blocks)
+        return '\n\n'.join(self.process_block(block) for block in blocks)
+
+    def prefetch(self, blocks):
+        """Download the remote images in blocks ahead of converting them."""
+        srcs = []
+        for block in blocks:
+            if block.lstrip().startswith('<img'):
+                match = self.src_re.search(block)
+                if match:
+                    srcs.append(match.group(1))
+        self.image_fetcher.prefetch(srcs)
+
+    def process_block(self, block):
+        stripped = block.strip()
+        if stripped.startswith('<img'):
+            try:
+                return Img2Latex(self.image_fetcher).convert(stripped).strip()
+            except xml.parsers.expat.ExpatError:
+                # not an img tag on its own, such as one followed by text
+                pass
+        return block
+
+
+def image_filename(url):
+    """Return a name for the local copy of the image at url: the last part
+    of its path, without any query string."""
+    name = os.path.basename(unquote(urlparse(url).path))
+    if name in ('', '.', '..'):
+        return 'image'
+    return name
+
+
+class ImageFetcher(object):
+    """Download remote images to local files for Img2Latex.
+
+    fetch(src) returns the name of a local copy of the image at src, or src
+    itself if it is not a remote url or is not there, and remembers the
+    answer until forget() is called. prefetch(srcs) fetches many images
+    ahead of time, up to max_workers at once. Connections are kept alive
+    and reused for further requests to the same host.
+
+    Each image takes one GET, following redirects, which is streamed to
+    disk chunk_size bytes at a time. Images over max_size bytes, servers
+    slower than timeout seconds and any other failure leave src as it is.
+
+    Given an ImageCache, images are kept there rather than in temporary
+    directories, and cached images are only downloaded again if the server
+    says they have changed.
+    """
+
+    chunk_size = 64 * 1024
+    max_redirects = 5
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_workers=1, timeout=30, max_size=64 * 1024 * 1024,
+                 cache=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_size = max_size
+        self.cache = cache
+        # a ConversionStats to record each image in, if any
+        self.stats = None
+        # the local path of each image fetched since forget() was last called
+        self.fetched = {}
+        # idle connections by (scheme, host)
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, srcs):
+        todo = []
+        for src in srcs:
+            if src in self.fetched or src in todo:
+                if self.stats is not None:
+                    self.stats.record_image_hit(src)
+            elif urlparse(src).scheme != '':
+                todo.append(src)
+        if self.max_workers > 1 and len(todo) > 1:
+            workers = min(self.max_workers, len(todo))
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                for src in pool.map(self.fetch, todo):
+                    pass
+        else:
+            for src in todo:
+                self.fetch(src)
+
+    def forget(self):
+        """Forget the images fetched so far, so that they are fetched again,
+        or revalidated if cached, when next wanted."""
+        self.fetched.clear()
+        if self.cache is not None:
+            self.cache.release()
+
+    def fetch(self, src):
+        if urlparse(src).scheme == '':
+            return src
+        if src not in self.fetched:
+            self.fetched[src] = self.download(src)
+        return self.fetched[src]
+
+    def download(self, src):
+        start = time.perf_counter()
+        cached = None
+        headers = {}
+        if self.cache is not None:
+            cached = self.cache.lookup(src)
+            if cached is not None:
+                headers = self.cache.validators(cached)
+        url = src
+        try:
+            for hop in range(self.max_redirects + 1):
+                with self.request('GET', url, headers) as response:
+                    location = response.getheader('Location')
+                    if response.status in self.redirect_codes and location:
+                        response.read()
+                        url = urljoin(url, location)
+                        continue
+                    if response.status == 304 and cached is not None:
+                        response.read()
+                        self.cache.touch(src)
+                        return self.done(src, start, 'revalidated',
+                                         cached['path'])
+                    if response.status != 200:
+                        break
+                    return self.done(src, start, 'downloaded',
+                                     self.save(src, response))
+        except (OSError, ValueError, http.client.HTTPException):
+            pass
+        return self.done(src, start, 'failed', src)
+
+    def done(self, src, start, outcome, path):
+        """Record how fetching src went, if keeping stats, and return the
+        local path for it."""
+        if self.stats is not None:
+            self.stats.record_image(src, outcome, time.perf_counter() - start)
+        return path
+
+    def save(self, src, response):
+        """Stream the body of the response for src to a file, and return
+        the file's name."""
+        length = response.getheader('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_size:
+            raise ValueError('%s is over %d bytes' % (src, self.max_size))
+        if self.cache is not None:
+            folder = self.cache.directory
+        else:
+            folder = tempfile.mkdtemp()
+        fd, tmp = tempfile.mkstemp(dir=folder)
+        path = None
+        try:
+            with os.fdopen(fd, 'wb') as fo:
+                size = 0
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise ValueError('%s is over %d bytes' % (
+                            src, self.max_size))
+                    fo.write(chunk)
+            if self.cache is not None:
+                path = self.cache.store(src, tmp, response)
+            else:
+                path = os.path.join(folder, image_filename(src))
+                replace_file(tmp, path)
+            return path
+        finally:
+            if path is None:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                if self.cache is None:
+                    shutil.rmtree(folder, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def request(self, method, url, headers={}):
+        """Send a request for url over a pooled connection and yield the
+        response. The connection goes back in the pool if the response has
+        been read to the end and the server will keep it open."""
+        parts = urlparse(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        # a kept alive connection may have been closed by the server since
+        # it was last used, in which case we try once more on a new one
+        for attempt in range(2):
+            with self.lock:
+                idle = self.connections.get(key)
+                conn = idle.pop() if idle else None
+            if conn is None:
+                if parts.scheme == 'https':
+                    conn = http.client.HTTPSConnection(parts.netloc,
+                                                       timeout=self.timeout)
+                else:
+                    conn = http.client.HTTPConnection(parts.netloc,
+                                                      timeout=self.timeout)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if attempt:
+                    raise
+        try:
+            yield response
+        finally:
+            if response.isclosed() and not response.will_close:
+                with self.lock:
+                    self.connections.setdefault(key, []).append(conn)
             else:
-                new_blocks.append(block)
-        return '\n\n'.join(new_blocks)
+                conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            for idle in self.connections.values():
+                for conn in idle:
+                    conn.close()
+            self.connections.clear()
+
+
+class ImageCache(object):
+    """An on-disk cache of downloaded images, keyed by url.
+
+    The image for a url is kept as <directory>/<key>/<file name>, where key
+    is the sha1 of the url, next to a <key>.json file recording the url and
+    its ETag and Last-Modified headers. When the cache grows beyond max_size
+    bytes the least recently used images are removed, other than those used
+    since release() was last called, which the document being converted
+    may still need.
+
+    The size and last use of each entry are read from the directory once,
+    and then kept up to date in memory, so entries other processes add
+    after that are not counted.
+    """
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # [last used, size] of each entry by key, and their total size,
+        # once read by index()
+        self.entries = None
+        self.total = 0
+        # the keys of the entries used since release()
+        self.in_use = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def index(self):
+        """Return the entries, reading them from the directory the first
+        time. The lock must be held."""
+        if self.entries is None:
+            self.entries = {}
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                meta = os.path.join(self.directory, name)
+                try:
+                    with open(meta) as fo:
+                        size = json.load(fo).get('size', 0)
+                    used = os.path.getmtime(meta)
+                except (OSError, ValueError):
+                    continue
+                self.entries[name[:-len('.json')]] = [used, size]
+            self.total = sum(size for used, size in self.entries.values())
+        return self.entries
+
+    def use(self, key, size=None):
+        """Mark the entry key as just used, and so kept until release(),
+        with its size if it has just been stored."""
+        with self.lock:
+            entries = self.index()
+            self.in_use.add(key)
+            if size is not None:
+                if key in entries:
+                    self.total -= entries[key][1]
+                entries[key] = [time.time(), size]
+                self.total += size
+            elif key in entries:
+                entries[key][0] = time.time()
+
+    def release(self):
+        """Let the entries used so far be evicted again."""
+        with self.lock:
+            self.in_use.clear()
+
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def lookup(self, url):
+        """Return the cache entry for url, with the image's local path, or
+        None if there is none."""
+        key = self.key(url)
+        try:
+            with open(os.path.join(self.directory, key + '.json')) as fo:
+                entry = json.load(fo)
+        except (OSError, ValueError):
+            return None
+        entry['path'] = os.path.join(self.directory, key, entry['file'])
+        if entry.get('url') != url or not os.path.exists(entry['path']):
+            return None
+        self.use(key)
+        return entry
+
+    def validators(self, entry):
+        """Return the headers asking for url only if it has changed."""
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, url):
+        """Mark the entry for url as just used."""
+        key = self.key(url)
+        try:
+            os.utime(os.path.join(self.directory, key + '.json'))
+        except OSError:
+            pass
+        self.use(key)
+
+    def store(self, url, tmp, response):
+        """Move tmp, a file in the cache directory holding the body of the
+        response to a request for url, into the cache and return its new
+        path."""
+        key = self.key(url)
+        folder = os.path.join(self.directory, key)
+        os.makedirs(folder, exist_ok=True)
+        filename = image_filename(url)
+        path = os.path.join(folder, filename)
+        # images and entries are written to temporary files and moved into
+        # place, so that nothing ever sees a partial one
+        replace_file(tmp, path)
+        entry = {
+            'url': url,
+            'file': filename,
+            'etag': response.getheader('ETag'),
+            'last_modified': response.getheader('Last-Modified'),
+            'size': os.path.getsize(path),
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as fo:
+            json.dump(entry, fo)
+        replace_file(tmp, os.path.join(self.directory, key + '.json'))
+        self.use(key, entry['size'])
+        self.evict()
+        return path
+
+    def evict(self):
+        """Remove least recently used entries, other than those in use,
+        until the cache is no bigger than max_size."""
+        with self.lock:
+            entries = self.index()
+            if self.total <= self.max_size:
+                return
+            for key in sorted(entries, key=lambda key: entries[key][0]):
+                if self.total <= self.max_size:
+                    break
+                if key in self.in_use:
+                    continue
+                try:
+                    os.remove(os.path.join(self.directory, key + '.json'))
+                except OSError:
+                    pass
+                shutil.rmtree(os.path.join(self.directory, key),
+                              ignore_errors=True)
+                self.total -= entries.pop(key)[1]
 
 
 class Img2Latex(object):
+    def __init__(self, image_fetcher=None):
+        self.image_fetcher = image_fetcher or ImageFetcher()
+
     def convert(self, instr):
         dom = xml.dom.minidom.parseString(instr)
         img = dom.documentElement
-        src = img.getAttribute('src')
-
-        if urlparse(src).scheme != '':
-            src_urlparse = urlparse(src)
-            conn = http.client.HTTPConnection(src_urlparse.netloc)
-            conn.request('HEAD', src_urlparse.path)
-            response = conn.getresponse()
-            conn.close()
-            if response.status == 200:
-                filename = os.path.join(tempfile.mkdtemp(), src.split('/')[-1])
-                urllib.request.urlretrieve(src, filename)
-                src = filename
-
-        alt = img.getAttribute('alt')
+        return self.figure(img.getAttribute('src'), img.getAttribute('alt'))
+
+    def convert_element(self, element, inline=False):
+        """Convert an ElementTree img element, to a figure unless inline."""
+        if inline:
+            return self.graphic(element.get('src', ''))
+        return self.figure(element.get('src', ''),
+                           escape_latex_entities(element.get('alt', '')))
+
+    def graphic(self, src):
+        """Return the LaTeX for the image alone, without a float."""
+        src = self.image_fetcher.fetch(src)
+        return '\\includegraphics[max width=\\linewidth]{%s}' % src
+
+    def figure(self, src, alt):
+        src = self.image_fetcher.fetch(src)
 	# Using graphicx and ajustbox package for *max width*
         out = \
             """
@@ -455,43 +2119,54 @@ class Img2Latex(object):
 # ========================== LINKS =================================
 
 class LinkTextPostProcessor(markdown.postprocessors.Postprocessor):
+    link_re = re.compile(r'<a[^>]*>([^<]+)</a>')
 
     def run(self, instr):
         # Process all hyperlinks
+        return '\n\n'.join(self.process_block(block)
+                            for block in instr.split('\n\n'))
+
+    def process_block(self, block):
+        if '<a' not in block:
+            return block
+        stripped = block.strip()
         converter = Link2Latex()
-        new_blocks = []
-        for block in instr.split("\n\n"):
-            stripped = block.strip()
-            match = re.findall(r'<a[^>]*>[^<]+</a>', stripped)
-            # <table catches modified verions (e.g. <table class="..">
-            if match:
-                latex_link = stripped
-                # replace multiple <a> occurrences individually
-                for occurrence in match:
-                    latex_link = re.sub(r'<a[^>]*>([^<]+)</a>',
-                        converter.convert(occurrence).strip(),
-                        latex_link, count=1)
-                new_blocks.append(latex_link)
-            else:
-                new_blocks.append(block)
-        return '\n\n'.join(new_blocks)
+        # the LaTeX of each distinct anchor, as the same link is often
+        # repeated
+        done = {}
+
+        def replace(match):
+            anchor = match.group(0)
+            if anchor not in done:
+                try:
+                    done[anchor] = converter.convert(anchor)
+                except etree.ParseError:
+                    # such as an unquoted attribute, left as it is
+                    done[anchor] = anchor
+            return done[anchor]
+
+        # one scan of the block, with the LaTeX put in as it is rather than
+        # read as a replacement template
+        latex_link, count = self.link_re.subn(replace, stripped)
+        if not count:
+            return block
+        return latex_link
 
 
 class Link2Latex(object):
     def convert(self, instr):
-        dom = xml.dom.minidom.parseString(instr)
-        link = dom.documentElement
-        href = link.getAttribute('href')
+        # the html has been unescaped, so a & in the href is bare
+        link = etree.fromstring(escape_bare_ampersands(instr))
+        href = link.get('href', '')
 
         desc = re.search(r'>([^<]+)', instr)
-        if href == desc.group(1):
-            out = r"\\url{%s}" % (href)
-        else:
-            out = \
-                """
-                \\\href{%s}{%s}
-                """ % (href, desc.group(1))
-        return out
+        return self.format(href, desc.group(1))
+
+    def format(self, href, desc):
+        """Return the latex for a link to href described by desc."""
+        if href == desc:
+            return '\\url{%s}' % href
+        return '\\href{%s}{%s}' % (href, desc)
 
 
 """
@@ -508,7 +2183,9 @@ class FootnoteExtension (markdown.Extension):
     DEF_RE = re.compile(r"(\ ?\ ?\ ?)\[\^([^\]]*)\]:\s*(.*)")
     SHORT_USE_RE = re.compile(r"\[\^([^\]]*)\]", re.M)  # [^a]
 
-    def __init__(self, configs=None):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.md = None
         self.reset()
 
     def extendMarkdown(self, md):
@@ -517,151 +2194,618 @@ class FootnoteExtension (markdown.Extension):
         # Stateless extensions do not need to be registered
         md.registerExtension(self)
 
-        # Insert a preprocessor before ReferencePreprocessor
-        #index = md.preprocessors.index(md_globals['REFERENCE_PREPROCESSOR'])
-        #preprocessor = FootnotePreprocessor(self)
-        #preprocessor.md = md
-        #md.preprocessors.insert(index, preprocessor)
-        md.preprocessors.add('footnotes', FootnotePreprocessor(self), '_begin')
+        # after latex_math, so that maths in a footnote is kept as it is,
+        # and html_block
+        md.preprocessors.register(FootnotePreprocessor(self, md),
+                                  'footnotes', 15)
 
-        ## Insert an inline pattern before ImageReferencePattern
+        # before reference links, but after code spans
         FOOTNOTE_RE = r"\[\^([^\]]*)\]"  # blah blah [^1] blah
-        #index = md.inlinePatterns.index(md_globals['IMAGE_REFERENCE_PATTERN'])
-        #md.inlinePatterns.insert(index, FootnotePattern(FOOTNOTE_RE, self))
-        md.inlinePatterns.add('footnotes', FootnotePattern(FOOTNOTE_RE, self),
-                              '_begin')        
-        
+        md.inlinePatterns.register(FootnotePattern(FOOTNOTE_RE, self),
+                                   'footnotes', 175)
 
     def reset(self):
         self.used_footnotes = {}
+        # how many times each footnote is used
+        self.use_counts = collections.Counter()
         self.footnotes = {}
+        # the parsed body of each footnote asked for, by id
+        self.elements = {}
 
     def setFootnote(self, id, text):
         self.footnotes[id] = text
 
+    def footnoteElement(self, id):
+        """Return a div holding the body of footnote id parsed as markdown,
+        parsing it only the first time it is asked for."""
+        if id not in self.elements:
+            div = etree.Element('div')
+            self.md.parser.parseChunk(div, self.footnotes[id])
+            self.md.treeprocessors['inline'].run(div)
+            self.elements[id] = div
+        return self.elements[id]
+
 
-class FootnotePreprocessor:
-    def __init__(self, footnotes):
+class FootnotePreprocessor(markdown.preprocessors.Preprocessor):
+    TABBED_RE = re.compile(r'((\t)|(    ))(.*)')
+
+    def __init__(self, footnotes, md=None):
+        super().__init__(md)
         self.footnotes = footnotes
 
     def run(self, lines):
-        self.blockGuru = BlockGuru()
         lines = self._handleFootnoteDefinitions(lines)
 
-        # Make a hash of all footnote marks in the text so that we
-        # know in what order they are supposed to appear.  (This
-        # function call doesn't really substitute anything - it's just
-        # a way to get a callback for each occurence.
-
+        # Number the footnote marks in the text in the order they are
+        # supposed to appear. A mark may run over a line end, so look for
+        # them in the joined text.
         text = "\n".join(lines)
-        self.footnotes.SHORT_USE_RE.sub(self.recordFootnoteUse, text)
+        for match in self.footnotes.SHORT_USE_RE.finditer(text):
+            self.recordFootnoteUse(match)
 
-        return text.split("\n")
+        return lines
 
     def recordFootnoteUse(self, match):
         id = match.group(1)
         id = id.strip()
-        nextNum = len(list(self.footnotes.used_footnotes.keys())) + 1
-        self.footnotes.used_footnotes[id] = nextNum
+        used = self.footnotes.used_footnotes
+        if id not in used:
+            used[id] = len(used) + 1
+        self.footnotes.use_counts[id] += 1
 
     def _handleFootnoteDefinitions(self, lines):
-        """Recursively finds all footnote definitions in the lines.
+        """Finds all footnote definitions in the lines, in one pass.
 
             @param lines: a list of lines of text
-            @returns: a string representing the text with footnote
-                      definitions removed """
+            @returns: the lines with each footnote definition replaced by
+                      a blank line """
+
+        plain = []
+        i = 0
+        while i < len(lines):
+            m = self.footnotes.DEF_RE.match(lines[i])
+            if m is None or not m.group(2):
+                plain.append(lines[i])
+                i += 1
+                continue
+            detabbed, i = self._detectTabbed(lines, i + 1)
+            self.footnotes.setFootnote(m.group(2),
+                                       m.group(3) + "\n"
+                                       + "\n".join(detabbed))
+            plain.append("")
+        return plain
+
+    def _detectTabbed(self, lines, start):
+        """Finds the indented lines that continue a footnote definition.
 
-        i, id, footnote = self._findFootnoteDefinition(lines)
+            @param lines: a list of lines of text
+            @param start: the index of the line after the definition
+            @returns: the continuation lines with their indent removed, and
+                      the index of the first line after them """
+
+        items = []
+        i = start
+        while i < len(lines):
+            if lines[i].strip():
+                m = self.TABBED_RE.match(lines[i])
+                if not m or not m.group(4):
+                    return items, i
+                items.append(m.group(4))
+                i += 1
+                continue
+            # a blank line: the definition goes on if the next line that
+            # is not blank is indented
+            j = i + 1
+            while j < len(lines) and not lines[j].strip():
+                j += 1
+            m = j < len(lines) and self.TABBED_RE.match(lines[j])
+            if not m or not m.group(4):
+                # only the first blank line goes with the definition
+                return items, i + 1
+            items.extend([""] * (j - i))
+            i = j
+        return items, i
+
+
+class FootnotePattern(markdown.inlinepatterns.InlineProcessor):
+    """Replace a use of a footnote with an empty sup element naming it, for
+    LaTeXTreeProcessor to fill in. Uses of undefined footnotes are left as
+    they are."""
 
-        if id:
+    def __init__(self, pattern, footnotes):
+        super().__init__(pattern, footnotes.md)
+        self.footnotes = footnotes
 
-            plain = lines[:i]
+    def handleMatch(self, m, data):
+        id = m.group(1).strip()
+        if id not in self.footnotes.footnotes:
+            return None, None, None
+        return etree.Element('sup', {'footnote': id}), m.start(0), m.end(0)
 
-            detabbed, theRest = self.blockGuru.detectTabbed(lines[i + 1:])
 
-            self.footnotes.setFootnote(id,
-                                       footnote + "\n"
-                                       + "\n".join(detabbed))
+def template(template_fo, latex_to_insert):
+    return Template(template_fo.read()).render(latex_to_insert)
+    # title_items = [ '\\title', '\\end{abstract}', '\\thanks', '\\author' ]
+    # has_title_stuff = False
+    # for it in title_items:
+    #    has_title_stuff = has_title_stuff or (it in tmpl)
 
-            more_plain = self._handleFootnoteDefinitions(theRest)
-            return plain + [""] + more_plain
 
+def iter_stripped(fragments):
+    """Generate the fragments less the whitespace ''.join(fragments).strip()
+    would take off, without joining them."""
+    started = False
+    # whitespace held back in case it is at the end
+    pending = ''
+    for fragment in fragments:
+        if not started:
+            fragment = fragment.lstrip()
+            if not fragment:
+                continue
+            started = True
+        body = fragment.rstrip()
+        if body:
+            if pending:
+                yield pending
+            yield body
+            pending = fragment[len(body):]
         else:
-            return lines
+            pending += fragment
 
-    def _findFootnoteDefinition(self, lines):
-        """Finds the first line of a footnote definition.
 
-            @param lines: a list of lines of text
-            @returns: the index of the line containing a footnote definition.
-        """
+class Template(object):
+    """A LaTeX template, split at its slots once so that it can be filled
+    in any number of times.
 
-        counter = 0
-        for line in lines:
-            m = self.footnotes.DEF_RE.match(line)
-            if m:
-                return counter, m.group(2), m.group(3)
-            counter += 1
-        return counter, None, None
+    A slot is written INSERT-NAME-HERE, NAME being upper case letters, and
+    is known by its name in lower case: INSERT-TITLE-HERE is the title
+    slot. INSERT-TEXT-HERE is the text slot, where the converted document
+    goes. Slots not given a value are left as they are, so that text which
+    only looks like a slot is kept.
 
+        >>> tmpl = Template('INSERT-TITLE-HERE: INSERT-TEXT-HERE')
+        >>> print(tmpl.render('Some text', title='A title'))
+        A title: Some text
+    """
 
-class FootnotePattern(markdown.inlinepatterns.Pattern):
+    slot_re = re.compile(r'INSERT-([A-Z]+)-HERE')
+
+    def __init__(self, text):
+        # literal text and slot names by turns, starting and ending with
+        # literal text
+        self.parts = self.slot_re.split(text)
+        for ii in range(1, len(self.parts), 2):
+            self.parts[ii] = self.parts[ii].lower()
+
+    @staticmethod
+    def slot_text(name):
+        """Return how the slot name is written in a template."""
+        return 'INSERT-%s-HERE' % name.upper()
+
+    def fill(self, **slots):
+        """Return a copy of the template with the given slots filled in as
+        part of its literal text."""
+        parts = [self.parts[0]]
+        for name, text in zip(self.parts[1::2], self.parts[2::2]):
+            if name in slots:
+                parts[-1] += slots[name] + text
+            else:
+                parts.extend([name, text])
+        filled = Template('')
+        filled.parts = parts
+        return filled
+
+    def render(self, body='', **slots):
+        """Return the template with the body in its text slot and the other
+        slots filled in."""
+        slots['text'] = body
+        return ''.join([slots.get(part, self.slot_text(part)) if ii % 2
+                        else part for ii, part in enumerate(self.parts)])
+
+    def write(self, fileobj, fragments=(), **slots):
+        """Write the template to fileobj with the fragments, one by one, in
+        its text slot and the other slots filled in. The fragments are not
+        read at all if there is no text slot."""
+        if self.parts[1::2].count('text') > 1:
+            # the body goes in more than once, so has to be kept
+            slots['text'] = ''.join(fragments)
+        for ii, part in enumerate(self.parts):
+            if not ii % 2:
+                fileobj.write(part)
+            elif part == 'text' and 'text' not in slots:
+                fileobj.writelines(fragments)
+            else:
+                fileobj.write(slots.get(part, self.slot_text(part)))
 
-    def __init__(self, pattern, footnotes):
-        markdown.inlinepatterns.Pattern.__init__(self, pattern)
-        self.footnotes = footnotes
 
-    def handleMatch(self, m, doc):
-        sup = doc.createElement('sup')
-        id = m.group(2)
-        # stick the footnote text in the sup
-        self.footnotes.md._processSection(sup,
-                                          self.footnotes.footnotes[id].split("\n"))
-        return sup
+# the templates load_template has read, by path, with the modification time
+# and size of their files when it did
+templates = {}
 
 
-def template(template_fo, latex_to_insert):
-    tmpl = template_fo.read()
-    tmpl = tmpl.replace('INSERT-TEXT-HERE', latex_to_insert)
+def load_template(path):
+    """Return the Template in the file at path, reading and splitting it
+    only if the file has changed since it was last loaded."""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = templates.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with open(path) as fo:
+        tmpl = Template(fo.read())
+    templates[path] = stamp, tmpl
     return tmpl
-    # title_items = [ '\\title', '\\end{abstract}', '\\thanks', '\\author' ]
-    # has_title_stuff = False
-    # for it in title_items:
-    #    has_title_stuff = has_title_stuff or (it in tmpl)
 
 
-def main():
+markdown_extensions = ('.md', '.markdown', '.txt')
+
+
+def find_inputs(args):
+    """Return (path, name) for each input file named in args, which may be
+    files, glob patterns or directories to search for markdown files. name
+    is the path of the output file relative to the output directory."""
+    inputs = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for dirpath, dirnames, filenames in os.walk(arg):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    ext = os.path.splitext(filename)[1].lower()
+                    if ext in markdown_extensions:
+                        path = os.path.join(dirpath, filename)
+                        inputs.append((path, os.path.relpath(path, arg)))
+        elif glob.has_magic(arg):
+            for path in sorted(glob.glob(arg)):
+                inputs.append((path, os.path.basename(path)))
+        else:
+            inputs.append((arg, os.path.basename(arg)))
+    return inputs
+
+
+# the converter of each batch worker process, set up by init_batch
+batch = {}
+
+
+def init_batch(configs, tmpl=None, block_cache_dir='', stats=None):
+    batch['converter'] = make_converter(configs, block_cache_dir)
+    batch['template'] = tmpl
+    if stats is not None:
+        batch['converter'].extension.instrument(stats)
+
+
+def make_converter(configs, block_cache_dir=''):
+    """Return a converter with the given extension configs, which is
+    incremental if there is a directory for its block cache."""
+    if block_cache_dir:
+        return IncrementalConverter(cache=BlockCache(block_cache_dir),
+                                    **configs)
+    return LaTeXConverter(**configs)
+
+
+def convert_file(job):
+    """Convert the markdown file inpath to a LaTeX file outpath, for a batch
+    worker. Returns inpath and an error message, or None if all went well.
+    """
+    inpath, outpath = job
+    try:
+        with open(inpath) as infile:
+            text = infile.read()
+        outdir = os.path.dirname(outpath)
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+        with atomic_file(outpath) as outfile:
+            batch['converter'].convert_to(text, outfile, batch['template'])
+            outfile.write('\n')
+    except Exception as inst:
+        return inpath, '%s: %s' % (type(inst).__name__, inst)
+    return inpath, None
+
+
+def convert_batch(jobs, configs, tmpl=None, processes=1,
+                  block_cache_dir='', stats=None):
+    """Convert each (inpath, outpath) in jobs over a pool of processes, and
+    return a list of (inpath, error message) for those that failed. If
+    given, tmpl is the Template each output file is written in, and the
+    conversions are measured in the ConversionStats stats, in this process
+    only."""
+    if processes > 1 and len(jobs) > 1 and stats is None:
+        processes = min(processes, len(jobs))
+        chunksize = max(1, len(jobs) // (processes * 4))
+        with multiprocessing.Pool(processes, init_batch,
+                                  (configs, tmpl, block_cache_dir)) as pool:
+            results = list(pool.imap_unordered(convert_file, jobs,
+                                               chunksize))
+    else:
+        init_batch(configs, tmpl, block_cache_dir, stats)
+        results = [convert_file(job) for job in jobs]
+    return [(inpath, error) for inpath, error in results if error]
+
+
+# the umask, read once as the only way to read it is to set it
+umask = os.umask(0)
+os.umask(umask)
+
+
+def replace_file(tmp, path):
+    """Move tmp, made by tempfile.mkstemp and so only readable by its
+    owner, to path, with the mode of the file there or, if there is none,
+    the mode a new file would have."""
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0o666 & ~umask
+    os.chmod(tmp, mode)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def atomic_file(path):
+    """Open a temporary file to write in place of path, and move it there
+    once the block is done, so that nothing ever sees the file half written.
+    If the block fails path is left as it was."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as fo:
+            yield fo
+        replace_file(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class Watcher(object):
+    """Convert a markdown file to a LaTeX file, with a template if given,
+    and again whenever either of them changes.
+
+    The files are polled every interval seconds. Once they have changed
+    the watcher waits for them to stay the same for debounce seconds, so
+    that a burst of saves makes one rebuild, and then only converts again
+    if their content is different from that of the last build.
+    """
+
+    def __init__(self, inpath, outpath, converter, template_path='',
+                 interval=0.5, debounce=0.2, slots=None):
+        self.inpath = inpath
+        self.outpath = outpath
+        self.converter = converter
+        self.template_path = template_path
+        # values for the other slots of the template
+        self.slots = slots or {}
+        self.interval = interval
+        self.debounce = debounce
+        # the hash of the sources of the last build
+        self.digest = None
+        self.builds = 0
+
+    def paths(self):
+        return [path for path in (self.inpath, self.template_path) if path]
+
+    def state(self):
+        """Return the modification time and size of each file."""
+        state = []
+        for path in self.paths():
+            try:
+                stat = os.stat(path)
+                state.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                state.append(None)
+        return state
+
+    def build(self):
+        """Convert the input if it has changed since the last build, and
+        return whether it was."""
+        sources = []
+        for path in self.paths():
+            with open(path) as fo:
+                sources.append(fo.read())
+        digest = hashlib.sha1('\0'.join(sources).encode('utf-8')).digest()
+        if digest == self.digest:
+            return False
+        tmpl = None
+        if self.template_path:
+            tmpl = Template(sources[1])
+        with atomic_file(self.outpath) as fo:
+            self.converter.convert_to(sources[0], fo, tmpl, **self.slots)
+            fo.write('\n')
+        self.digest = digest
+        self.builds += 1
+        return True
+
+    def try_build(self):
+        try:
+            if self.build():
+                sys.stderr.write('wrote %s\n' % self.outpath)
+        except Exception as inst:
+            # keep watching, as the next save may well fix it
+            sys.stderr.write('%s: %s: %s\n' % (self.inpath,
+                                               type(inst).__name__, inst))
+
+    def run(self, stop=None):
+        """Watch until stop, a threading.Event, is set."""
+        stop = stop or threading.Event()
+        state = self.state()
+        self.try_build()
+        while not stop.wait(self.interval):
+            new_state = self.state()
+            if new_state == state:
+                continue
+            while not stop.wait(self.debounce):
+                settled = self.state()
+                if settled == new_state:
+                    break
+                new_state = settled
+            state = new_state
+            if not stop.is_set():
+                self.try_build()
+
+
+def main(args=None):
     import optparse
     usage = \
         """usage: %prog [options] <in-file-path>
+       %prog [options] -o <out-dir> <in-path> ...
 
         Given a file path, process it using markdown2latex and print the result on
         stdout.
 
+        Given an output directory, convert each of the input files, directories
+        (searched for .md, .markdown and .txt files) or glob patterns into a .tex
+        file there, using --jobs processes.
+
+        With --watch, keep converting the input file whenever it changes.
+
+        With --profile, print how long each stage of conversion took, and each
+        remote image took to fetch, on stderr at the end.
+
         If using template option template should place text INSERT-TEXT-HERE in the
-        template where text should be inserted.
+        template where text should be inserted. Other INSERT-NAME-HERE slots in it
+        are filled in with --slot name=value.
         """
     parser = optparse.OptionParser(usage)
     parser.add_option('-t', '--template', dest='template',
                       default='',
                       help='path to latex template file (optional)')
-    (options, args) = parser.parse_args()
+    parser.add_option('-s', '--slot', dest='slots', action='append',
+                      default=[], metavar='NAME=VALUE',
+                      help='fill the INSERT-NAME-HERE slot of the template '
+                           'with VALUE (may be given more than once)')
+    parser.add_option('-o', '--output-dir', dest='output_dir',
+                      default='',
+                      help='directory to write converted files to (optional)')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='number of processes converting files at once '
+                           'with --output-dir')
+    parser.add_option('-w', '--watch', dest='watch', action='store_true',
+                      default=False,
+                      help='convert the input file to a .tex file in the '
+                           'output directory, or next to it, and again '
+                           'whenever it or the template changes')
+    parser.add_option('--watch-interval', dest='watch_interval',
+                      type='float', default=0.5,
+                      help='seconds between checks for changes with --watch')
+    parser.add_option('--block-cache-dir', dest='block_cache_dir',
+                      default='',
+                      help='directory to keep the LaTeX of each block in, so '
+                           'that only changed blocks are converted again '
+                           '(optional)')
+    parser.add_option('--longtable-rows', dest='longtable_rows', type='int',
+                      default=0,
+                      help='output tables with more rows than this as '
+                           'longtables (needs the longtable package)')
+    parser.add_option('--image-workers', dest='image_workers', type='int',
+                      default=1,
+                      help='number of remote images to download at once')
+    parser.add_option('--image-cache-dir', dest='image_cache_dir',
+                      default='',
+                      help='directory to keep downloaded images in between '
+                           'runs (optional)')
+    parser.add_option('--image-cache-size', dest='image_cache_size',
+                      type='int', default=512,
+                      help='size in megabytes of the image cache')
+    parser.add_option('--profile', dest='profile', action='store_true',
+                      default=False,
+                      help='print the calls, time and characters in and out '
+                           'of each stage of conversion, and the time taken '
+                           'by each remote image, on stderr (converts in '
+                           'one process)')
+    parser.add_option('--profile-output', dest='profile_output',
+                      default='', metavar='FILE',
+                      help='run under cProfile and write its stats to FILE, '
+                           'for the pstats module (converts in one process)')
+    (options, args) = parser.parse_args(args)
     if not len(args) > 0:
         parser.print_help()
         sys.exit(1)
+    slots = {}
+    for slot in options.slots:
+        name, sep, value = slot.partition('=')
+        if not sep:
+            parser.error('--slot takes name=value, not %r' % slot)
+        slots[name.lower()] = value
+    tmpl = None
+    if options.template:
+        tmpl = load_template(options.template).fill(**slots)
+    configs = {
+        'image_workers': options.image_workers,
+        'image_cache_dir': options.image_cache_dir,
+        'image_cache_size': options.image_cache_size,
+        'longtable_rows': options.longtable_rows,
+    }
+    stats = ConversionStats() if options.profile else None
+    profiler = None
+    if options.profile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        convert_main(parser, options, args, configs, tmpl, stats, slots)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options.profile_output)
+        if stats is not None:
+            sys.stderr.write(stats.summary() + '\n')
+
+
+def convert_main(parser, options, args, configs, tmpl, stats, slots):
+    """Do the conversions asked for on the command line."""
+    if options.watch:
+        if len(args) > 1:
+            parser.error('--watch takes one input file')
+        inpath = args[0]
+        outdir = options.output_dir or os.path.dirname(inpath)
+        outpath = os.path.join(
+            outdir, os.path.splitext(os.path.basename(inpath))[0] + '.tex')
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+        # always incremental, so that a small edit makes a quick rebuild
+        converter = IncrementalConverter(
+            cache=BlockCache(options.block_cache_dir or None), **configs)
+        if stats is not None:
+            converter.extension.instrument(stats)
+        watcher = Watcher(inpath, outpath, converter, options.template,
+                          interval=options.watch_interval, slots=slots)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if options.output_dir:
+        jobs = []
+        # the input written to each output file, as two inputs of the same
+        # name in different places would overwrite each other
+        outputs = {}
+        for path, name in find_inputs(args):
+            outpath = os.path.join(options.output_dir,
+                                   os.path.splitext(name)[0] + '.tex')
+            other = outputs.setdefault(os.path.normcase(outpath), path)
+            if other == path:
+                jobs.append((path, outpath))
+            elif os.path.realpath(other) != os.path.realpath(path):
+                parser.error('%s and %s would both be written to %s' % (
+                    other, path, outpath))
+        # cProfile only sees this process
+        processes = 1 if options.profile_output else options.jobs
+        errors = convert_batch(jobs, configs, tmpl, processes,
+                               options.block_cache_dir, stats)
+        for inpath, error in errors:
+            sys.stderr.write('%s: %s\n' % (inpath, error))
+        if errors:
+            sys.exit(1)
+        return
+
+    if len(args) > 1:
+        parser.error('more than one input file needs --output-dir')
     inpath = args[0]
 
     with open(inpath) as infile:
-        md = markdown.Markdown()
-        mkdn2latex = LaTeXExtension()
-        mkdn2latex.extendMarkdown(md)
-        out = md.convert(infile.read())
-
-    if options.template:
-        with open(options.template) as tmpl_fo:
-            out = template(tmpl_fo, out)
-
-    print(out)
+        text = infile.read()
+    converter = make_converter(configs, options.block_cache_dir)
+    if stats is not None:
+        converter.extension.instrument(stats)
+    converter.convert_to(text, sys.stdout, tmpl)
+    sys.stdout.write('\n')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,814 @@
+"""Benchmarks for mdx_latex.
+
+Run all of them, or just the named ones, with::
+
+    $ python mdx_latex_bench.py [options] [name ...]
+
+Each benchmark prints a small table of timings. They are not part of the
+test suite.
+
+The stages benchmark converts a generated document and times each stage of
+the conversion on its own. The document's size, mix of blocks and random
+seed are set with options, and the results can be saved as JSON and
+compared with an earlier run::
+
+    $ python mdx_latex_bench.py -o before.json stages
+    $ python mdx_latex_bench.py -c before.json stages
+"""
+import io
+import json
+import optparse
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as etree
+
+import markdown
+import mdx_latex
+
+
+def best_time(func, repeat=3):
+    """Return the best wall time in seconds of `repeat` calls to func."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def nested_tree(depth, width):
+    """Return a tree of `depth` nested blockquotes each holding `width`
+    paragraphs, so that it has depth * (width + 1) nodes."""
+    root = etree.Element('div')
+    node = root
+    for level in range(depth):
+        node = etree.SubElement(node, 'blockquote')
+        for ii in range(width):
+            para = etree.SubElement(node, 'p')
+            para.text = 'Paragraph %s at level %s with "quoted" text. ' % (
+                ii, level)
+            em = etree.SubElement(para, 'em')
+            em.text = 'emphasis'
+            em.tail = ' and some more text & stuff.'
+    return root
+
+
+def bench_tolatex():
+    """LaTeXTreeProcessor.tolatex against document size and nesting depth.
+
+    The time per node should stay flat down both tables.
+    """
+    processor = mdx_latex.LaTeXTreeProcessor()
+
+    def report(shapes):
+        print('%8s %8s %10s %10s %10s' % ('depth', 'width', 'nodes',
+                                          'seconds', 'us/node'))
+        for depth, width in shapes:
+            tree = nested_tree(depth, width)
+            nodes = sum(1 for _ in tree.iter())
+            secs = best_time(lambda: processor.tolatex(tree))
+            print('%8d %8d %10d %10.4f %10.3f' % (depth, width, nodes, secs,
+                                                  secs / nodes * 1e6))
+
+    print('document size (fixed depth)')
+    report([(10, 100), (10, 1000), (10, 10000)])
+    print('nesting depth (fixed size)')
+    report([(25, 2000), (100, 500), (400, 125), (2000, 25), (10000, 5)])
+
+
+def tagged_tree(paras):
+    """Return a tree of `paras` paragraphs and lists, made mostly of the
+    inline tags common in real documents."""
+    root = etree.Element('div')
+    for ii in range(paras):
+        para = etree.SubElement(root, 'p')
+        para.text = 'Paragraph %d with ' % ii
+        for tag in ('em', 'strong', 'code', 'em', 'a', 'em', 'strong'):
+            child = etree.SubElement(para, tag)
+            child.text = 'some %s' % tag
+            child.tail = ' and '
+            if tag == 'a':
+                child.set('href', 'http://example.com/%d' % ii)
+        items = etree.SubElement(root, 'ul')
+        for jj in range(3):
+            item = etree.SubElement(items, 'li')
+            item.text = 'item %d ' % jj
+            etree.SubElement(item, 'em').text = 'stressed'
+    return root
+
+
+def bench_tags():
+    """LaTeXTreeProcessor.tolatex on a tree of mostly inline tags, per
+    node."""
+    processor = mdx_latex.LaTeXTreeProcessor()
+    print('%8s %10s %10s' % ('nodes', 'seconds', 'us/node'))
+    for paras in (100, 1000, 10000):
+        tree = tagged_tree(paras)
+        nodes = sum(1 for _ in tree.iter())
+        secs = best_time(lambda: processor.tolatex(tree))
+        print('%8d %10.4f %10.3f' % (nodes, secs, secs / nodes * 1e6))
+
+
+PROSE = ('It\'s a "truth" universally acknowledged, that a single man in '
+         'possession of a good fortune, must be in want of a wife. However '
+         'little known the feelings or views of such a man may be on his '
+         'first entering a neighbourhood, this truth is so well fixed in the '
+         'minds of the surrounding families, that he is considered the '
+         'rightful property of some one or other of their daughters. Some '
+         '50% of A&amp;B\'s #1 "fans" agree. ')
+
+
+start_single_quote_re = re.compile("(^|\\s|\")'")
+start_double_quote_re = re.compile("(^|\\s|'|`)\"")
+end_double_quote_re = re.compile("\"(,|\\.|\\s|$)")
+
+
+def escape_latex_entities_chain(text):
+    """The replace-and-substitute chain that escape_latex_entities used to
+    be, kept as a baseline."""
+    out = mdx_latex.unescape_html_entities(text)
+    out = out.replace('%', '\\%')
+    out = out.replace('&', '\\&')
+    out = out.replace('#', '\\#')
+    out = start_single_quote_re.sub('\\g<1>`', out)
+    out = start_double_quote_re.sub('\\g<1>``', out)
+    out = end_double_quote_re.sub("''\\g<1>", out)
+    return out
+
+
+def bench_escape():
+    """escape_latex_entities against the old chain of passes on prose."""
+    print('%-12s %8s %12s %12s' % ('input', 'chars', 'chain us',
+                                   'fused us'))
+    for name, text in [('words', 'a few words of text'),
+                       ('paragraph', PROSE),
+                       ('chapter', PROSE * 200),
+                       ('plain', 'word ' * 100)]:
+        assert escape_latex_entities_chain(text) == \
+            mdx_latex.escape_latex_entities(text)
+        number = max(1, 200000 // len(text))
+        times = []
+        for func in (escape_latex_entities_chain,
+                     mdx_latex.escape_latex_entities):
+            secs = min(timeit.repeat(lambda: func(text), number=number,
+                                     repeat=3))
+            times.append(secs / number * 1e6)
+        print('%-12s %8d %12.2f %12.2f' % (name, len(text), times[0],
+                                           times[1]))
+
+
+block_math_re = re.compile('\\$\\$([^\\$]*)\\$\\$')
+inline_math_re = re.compile('\\$([^\\$]*)\\$')
+
+
+def math_passes(instr):
+    """The substitution passes that MathTextPostProcessor.run used to make,
+    kept as a baseline."""
+    def repl_1(matchobj):
+        text = mdx_latex.unescape_latex_entities(matchobj.group(1))
+        return '\\[%s\\]' % text
+
+    def repl_2(matchobj):
+        text = mdx_latex.unescape_latex_entities(matchobj.group(1))
+        return '\\(%s\\)' % text
+
+    out = block_math_re.sub(repl_1, instr)
+    out = inline_math_re.sub(repl_2, out)
+    out = out.replace('\\lt', '<')
+    out = out.replace(' * ', ' \\cdot ')
+    out = out.replace('\\del', '\\partial')
+    return out
+
+
+MATHS = ('Let $x \\lt y$ and $f(x) = x^2 * 3$, so that\n\n'
+         '$$\\int_0^1 f(x) \\, dx = 1 \\del y$$\n\n'
+         'holds for $n$ in $\\mathbb{N}$. ')
+
+
+def inline_html_passes(text):
+    """The searches and replaces that inline_html_latex used to make, kept
+    as a baseline."""
+    out = text
+    if re.search(r'&ldquo;.*?&rdquo;', text, flags=re.DOTALL):
+        out = out.replace('&ldquo;', '\\enquote{').replace('&rdquo;', '}')
+    if re.search(r'&lsquo;.*?&rsquo;', text, flags=re.DOTALL):
+        out = out.replace('&lsquo;', '\\enquote{').replace('&rsquo;', '}')
+    if re.search(r'&ldquo;.*?&ldquo;', text, flags=re.DOTALL):
+        out = out.replace('&ldquo;', '\\enquote{', 1).replace(
+            '&ldquo;', '}', 1)
+    if re.search(r'&laquo;.*?&raquo;', text, flags=re.DOTALL):
+        out = out.replace('&laquo;', '\\enquote{').replace('&raquo;', '}')
+    out = out.replace('...', '\\dots')
+    out = out.replace('&hellip;', '\\dots')
+    out = out.replace('&ndash;', '--')
+    out = out.replace('&mdash;', '---')
+    out = out.replace('\\|', '|')
+    return out
+
+
+SMARTY = ('&ldquo;It is a truth&rdquo; &ndash; she said &mdash; &ldquo;that '
+          'a man&hellip; must be in want of a wife.&rdquo; ')
+
+
+def bench_smarty():
+    """inline_html_latex against the old searches and replaces, on prose
+    without entities, with the entities smarty leaves, and with a left
+    quote that is never closed, which makes the old searches scan to the
+    end of the text."""
+    print('%-12s %8s %12s %12s' % ('input', 'chars', 'passes us',
+                                   'one pass us'))
+    for name, text in [('plain', 'word ' * 20000),
+                       ('smarty', SMARTY * 1000),
+                       ('unclosed', '&lsquo;' + 'word ' * 20000)]:
+        times = []
+        for func in (inline_html_passes, mdx_latex.inline_html_latex):
+            times.append(best_time(lambda: func(text)) * 1e6)
+        print('%-12s %8d %12.1f %12.1f' % (name, len(text), times[0],
+                                           times[1]))
+
+
+def bench_math():
+    """MathTextPostProcessor against the old substitution passes, on prose
+    without maths and on maths dense text."""
+    processor = mdx_latex.MathTextPostProcessor()
+    print('%-12s %8s %12s %12s' % ('input', 'chars', 'passes us',
+                                   'scan us'))
+    for name, text in [('no maths', PROSE * 200),
+                       ('maths', MATHS * 200),
+                       ('mixed', (PROSE + MATHS) * 100)]:
+        assert math_passes(text) == processor.run(text)
+        number = max(1, 200000 // len(text))
+        times = []
+        for func in (math_passes, processor.run):
+            secs = min(timeit.repeat(lambda: func(text), number=number,
+                                     repeat=3))
+            times.append(secs / number * 1e6)
+        print('%-12s %8d %12.2f %12.2f' % (name, len(text), times[0],
+                                           times[1]))
+
+
+def bench_paper():
+    """A whole formula heavy document through a LaTeXConverter."""
+    converter = mdx_latex.LaTeXConverter()
+    text = '\n\n'.join([PROSE, MATHS * 20] * 10)
+    secs = best_time(lambda: converter.convert(text))
+    print('%8s %10s' % ('chars', 'ms'))
+    print('%8d %10.2f' % (len(text), secs * 1e3))
+
+
+def html_table(rows, cols=6):
+    """Return the html source of a table with the given number of rows."""
+    lines = ['<table>', '<caption>Data</caption>', '<thead>', '<tr>']
+    lines.extend('<th>Column %d</th>' % ii for ii in range(cols))
+    lines.extend(['</tr>', '</thead>', '<tbody>'])
+    for row in range(rows):
+        lines.append('<tr>')
+        lines.extend('<td>%d &amp; <em>%d%%</em></td>' % (row, col)
+                     for col in range(cols))
+        lines.append('</tr>')
+    lines.extend(['</tbody>', '</table>'])
+    return '\n'.join(lines)
+
+
+def bench_table():
+    """Table2Latex.convert on html tables of growing size, with the peak
+    memory allocated while converting."""
+    print('%8s %10s %10s %10s' % ('rows', 'seconds', 'us/row', 'peak MB'))
+    for rows in (100, 1000, 10000, 50000):
+        html = html_table(rows)
+        secs = best_time(lambda: mdx_latex.Table2Latex().convert(html))
+        tracemalloc.start()
+        mdx_latex.Table2Latex().convert(html)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%8d %10.4f %10.2f %10.2f' % (rows, secs, secs / rows * 1e6,
+                                            peak / 1e6))
+
+
+tabbed_re = re.compile(r'((\t)|(    ))(.*)')
+
+
+def detect_tabbed(lines):
+    """The indented lines at the start of lines, less their indent, and the
+    rest, as BlockGuru.detectTabbed used to find them."""
+    items = []
+    for i, line in enumerate(lines):
+        if line.strip():
+            match = tabbed_re.match(line)
+            if not match or not match.group(4):
+                return items, lines[i:]
+            items.append(match.group(4))
+            continue
+        for next_line in lines[i + 1:]:
+            if next_line.strip():
+                break
+        else:
+            return items, lines[i + 1:]
+        match = tabbed_re.match(next_line)
+        if not match or not match.group(4):
+            return items, lines[i + 1:]
+        items.append('')
+    return items, []
+
+
+def footnote_definitions_recursive(footnotes, lines):
+    """Find the first footnote definition from the start of lines, and
+    recurse on the lines after it."""
+    for i, line in enumerate(lines):
+        match = footnotes.DEF_RE.match(line)
+        if match and match.group(2):
+            detabbed, rest = detect_tabbed(lines[i + 1:])
+            footnotes.setFootnote(match.group(2), match.group(3) + '\n' +
+                                  '\n'.join(detabbed))
+            return lines[:i] + [''] + footnote_definitions_recursive(
+                footnotes, rest)
+    return lines
+
+
+def footnotes_recursive(footnotes, lines):
+    """What FootnotePreprocessor.run used to do, kept as a baseline: the
+    recursive definition search, then numbering the uses counting the
+    numbered ones each time."""
+    lines = footnote_definitions_recursive(footnotes, lines)
+    for match in footnotes.SHORT_USE_RE.finditer('\n'.join(lines)):
+        used = footnotes.used_footnotes
+        used[match.group(1).strip()] = len(list(used.keys())) + 1
+    return lines
+
+
+def manuscript(notes):
+    """Return the lines of a manuscript with the given number of footnotes,
+    each defined after the paragraph using it."""
+    lines = []
+    for note in range(notes):
+        lines.extend(['%s As shown elsewhere[^%d].' % (PROSE, note), '',
+                      '[^%d]: See the appendix.' % note,
+                      '    A second line of the note.', ''])
+    return lines
+
+
+def bench_footnotes():
+    """FootnotePreprocessor against the old recursive definition search, and
+    converting the whole document, on manuscripts with more and more
+    footnotes. The time per footnote should stay flat for the preprocessor
+    and the conversion."""
+    converter = mdx_latex.LaTeXConverter()
+    print('%8s %14s %14s %14s' % ('notes', 'recursive us', 'one pass us',
+                                  'convert us'))
+    for notes in (100, 500, 900, 5000, 20000):
+        lines = manuscript(notes)
+        text = '\n'.join(lines)
+        times = []
+        for run in (footnotes_recursive, None):
+            def convert():
+                footnotes = mdx_latex.FootnoteExtension()
+                if run is None:
+                    mdx_latex.FootnotePreprocessor(footnotes).run(lines)
+                else:
+                    run(footnotes, lines)
+            try:
+                times.append('%14.2f' % (best_time(convert) / notes * 1e6))
+            except RecursionError:
+                times.append('%14s' % 'recursion')
+        secs = best_time(lambda: converter.convert(text), repeat=1)
+        print('%8d %s %s %14.2f' % (notes, times[0], times[1],
+                                    secs / notes * 1e6))
+
+
+link_re = re.compile(r'<a[^>]*>([^<]+)</a>')
+
+
+def links_rescan(block):
+    """What LinkTextPostProcessor.process_block used to do, kept as a
+    baseline: substitute each link in turn, scanning from the start of the
+    block each time. Links are converted as they are now, so only the
+    scanning differs."""
+    stripped = block.strip()
+    matches = link_re.findall(stripped)
+    latex = stripped
+    for anchor in re.findall(r'<a[^>]*>[^<]+</a>', stripped):
+        link = mdx_latex.Link2Latex().convert(anchor)
+        latex = link_re.sub(link.replace('\\', '\\\\'), latex, count=1)
+    return latex if matches else block
+
+
+def bibliography(entries):
+    """Return the html of one block listing the given number of links."""
+    return '\n'.join('%d. Author, <em>Title %d</em>, '
+                     '<a href="http://example.com/paper/%d">link</a>.'
+                     % (ii, ii, ii) for ii in range(entries))
+
+
+def bench_links():
+    """LinkTextPostProcessor on a block of more and more links, against
+    rescanning the block for each one. The time per link should stay flat.
+    """
+    processor = mdx_latex.LinkTextPostProcessor()
+    print('%8s %14s %14s' % ('links', 'rescan us', 'one scan us'))
+    for entries in (10, 100, 1000, 5000):
+        block = bibliography(entries)
+        assert links_rescan(block) == processor.process_block(block)
+        times = [best_time(lambda: func(block)) / entries * 1e6
+                 for func in (links_rescan, processor.process_block)]
+        print('%8d %14.2f %14.2f' % (entries, times[0], times[1]))
+
+
+def book(chapters):
+    """Return the markdown source of a book of the given number of
+    chapters, each with 30 paragraphs, a list and some maths."""
+    parts = []
+    for chapter in range(chapters):
+        parts.append('## Chapter %d' % chapter)
+        for para in range(30):
+            parts.append('Paragraph %d of chapter %d. %s See [the notes][n].'
+                         % (para, chapter, PROSE))
+        parts.append('* one\n* two\n* three')
+        parts.append(MATHS)
+    parts.append('[n]: http://example.com/notes')
+    return '\n\n'.join(parts)
+
+
+def bench_incremental():
+    """Rebuilding a book after a one line edit with IncrementalConverter,
+    against converting all of it with LaTeXConverter."""
+    print('%8s %10s %12s %12s' % ('chapters', 'blocks', 'full ms',
+                                  'rebuild ms'))
+    for chapters in (10, 30, 100):
+        text = book(chapters)
+        full = best_time(lambda: mdx_latex.LaTeXConverter().convert(text))
+        converter = mdx_latex.IncrementalConverter()
+        converter.convert(text)
+        edits = iter(range(1000))
+
+        def rebuild():
+            # a different edit every time, so there is always one block
+            # to convert
+            converter.convert(text.replace(
+                'Paragraph 3 of chapter 0.',
+                'Paragraph 3 of chapter 0 (%d).' % next(edits)))
+
+        secs = best_time(rebuild)
+        assert converter.reconverted == 1
+        blocks = len(mdx_latex.split_blocks(text)[0])
+        print('%8d %10d %12.1f %12.1f' % (chapters, blocks, full * 1e3,
+                                          secs * 1e3))
+
+
+def bench_write():
+    """Writing a report to a file with a template: convert() and template()
+    into one string, against convert_to() writing a block at a time. Peak is
+    the memory allocated while converting, less the source text."""
+    converter = mdx_latex.LaTeXConverter()
+    tmpl = LATEX_DOCUMENT.replace('%s', 'INSERT-TEXT-HERE')
+    path = os.path.join(tempfile.mkdtemp(), 'report.tex')
+
+    def whole(text):
+        out = mdx_latex.template(io.StringIO(tmpl), converter.convert(text))
+        with open(path, 'w') as fo:
+            fo.write(out + '\n')
+
+    def blocks(text):
+        with open(path, 'w') as fo:
+            converter.convert_to(text, fo, tmpl)
+            fo.write('\n')
+
+    print('%8s %10s %12s %12s %12s %12s' % ('chapters', 'out MB', 'whole s',
+                                            'blocks s', 'whole MB',
+                                            'blocks MB'))
+    for chapters in (10, 100, 300):
+        text = book(chapters)
+        row = []
+        for func in (whole, blocks):
+            tracemalloc.start()
+            func(text)
+            row.append(tracemalloc.get_traced_memory()[1] / 1e6)
+            tracemalloc.stop()
+        secs = [best_time(lambda: func(text)) for func in (whole, blocks)]
+        print('%8d %10.1f %12.3f %12.3f %12.1f %12.1f' % (
+            chapters, os.path.getsize(path) / 1e6, secs[0], secs[1],
+            row[0], row[1]))
+    shutil.rmtree(os.path.dirname(path))
+
+
+def template_replace(template_fo, latex_to_insert):
+    """What mdx_latex.template used to do, kept as a baseline."""
+    tmpl = template_fo.read()
+    tmpl = tmpl.replace('INSERT-TEXT-HERE', latex_to_insert)
+    return tmpl
+
+
+def bench_template():
+    """Putting a converted document in a template file, reading it and
+    replacing the marker against a Template from load_template()."""
+    path = os.path.join(tempfile.mkdtemp(), 'template.tex')
+    with open(path, 'w') as fo:
+        fo.write('\\documentclass{article}\n%s'
+                 '\\title{INSERT-TITLE-HERE}\n\\begin{document}\n'
+                 'INSERT-TEXT-HERE\n\\end{document}\n'
+                 % ('\\usepackage{amsmath}\n' * 50))
+    print('%-10s %8s %12s %12s' % ('document', 'chars', 'replace us',
+                                   'Template us'))
+    for name, latex in [('short', PROSE), ('chapter', PROSE * 200)]:
+        def old():
+            with open(path) as fo:
+                template_replace(fo, latex)
+
+        def new():
+            mdx_latex.load_template(path).render(latex, title='A title')
+
+        number = 2000
+        times = [min(timeit.repeat(func, number=number, repeat=3)) / number
+                 * 1e6 for func in (old, new)]
+        print('%-10s %8d %12.1f %12.1f' % (name, len(latex), times[0],
+                                           times[1]))
+    shutil.rmtree(os.path.dirname(path))
+
+
+LATEX_DOCUMENT = r"""\documentclass{article}
+\usepackage{longtable}
+\begin{document}
+%s
+\end{document}
+"""
+
+
+def bench_pdflatex(rows=5000):
+    """pdflatex on a document holding one generated table of `rows` rows,
+    output as a floating tabular and as a longtable. Needs pdflatex."""
+    if shutil.which('pdflatex') is None:
+        print('pdflatex not found, skipping')
+        return
+    html = html_table(rows)
+    print('%-10s %10s %10s' % ('output', 'seconds', 'status'))
+    for name, longtable_rows in [('tabular', 0), ('longtable', 100)]:
+        latex = mdx_latex.Table2Latex(longtable_rows).convert(html)
+        tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(tmpdir, 'table.tex'), 'w') as fo:
+            fo.write(LATEX_DOCUMENT % latex)
+        command = ['pdflatex', '-interaction=batchmode', '-halt-on-error',
+                   'table.tex']
+        try:
+            secs = best_time(lambda: subprocess.run(
+                command, cwd=tmpdir, stdout=subprocess.DEVNULL,
+                timeout=600, check=True), repeat=1)
+            status = 'ok'
+        except subprocess.CalledProcessError:
+            secs, status = float('nan'), 'failed'
+        except subprocess.TimeoutExpired:
+            secs, status = float('nan'), 'timed out'
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        print('%-10s %10.2f %10s' % (name, secs, status))
+
+
+SNIPPETS = ['A *short* comment.',
+            '# Heading\n\nA paragraph with a [link](http://example.com/).',
+            '* one\n* two\n\n> $x^2$ & more']
+
+
+def bench_convert():
+    """Per document cost of converting short snippets: a new Markdown
+    instance and LaTeXExtension per document, one reused LaTeXConverter,
+    and plain html conversion with one reused Markdown instance."""
+
+    def fresh():
+        for text in SNIPPETS:
+            md = markdown.Markdown()
+            mdx_latex.LaTeXExtension().extendMarkdown(md)
+            md.convert(text)
+
+    converter = mdx_latex.LaTeXConverter()
+
+    def reused():
+        for text in SNIPPETS:
+            converter.convert(text)
+
+    md = markdown.Markdown()
+
+    def html():
+        for text in SNIPPETS:
+            md.reset().convert(text)
+
+    number = 300
+    print('%-10s %12s' % ('', 'us/doc'))
+    for name, func in [('fresh', fresh), ('converter', reused),
+                       ('html', html)]:
+        secs = min(timeit.repeat(func, number=number, repeat=3))
+        print('%-10s %12.1f' % (name, secs / number / len(SNIPPETS) * 1e6))
+
+
+WORDS = ('the whale ship sea captain voyage harpoon deck mast sail crew '
+         'ocean wind storm island port chart compass rope lantern cabin '
+         'measure depth bearing log tide current reef anchor').split()
+
+# the kinds of block in a generated document, and how often each comes up
+MIX = {'prose': 6, 'list': 2, 'table': 1, 'math': 2, 'footnote': 1,
+       'image': 1, 'link': 2}
+
+
+class Corpus(object):
+    """Generate markdown documents made of a random mix of blocks. The same
+    seed gives the same document."""
+
+    def __init__(self, seed=0, mix=None):
+        self.rng = random.Random(seed)
+        self.mix = mix or MIX
+        self.footnotes = 0
+
+    def words(self, count):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(count))
+
+    def sentence(self):
+        return self.words(self.rng.randint(5, 15)).capitalize() + '.'
+
+    def prose(self):
+        return ' '.join(self.sentence() for _ in range(self.rng.randint(2, 6)))
+
+    def list(self, depth=0):
+        lines = []
+        bullet = self.rng.choice(['*', '1.'])
+        for _ in range(self.rng.randint(2, 5)):
+            lines.append('%s%s %s' % ('    ' * depth, bullet, self.sentence()))
+            if depth < 2 and self.rng.random() < 0.3:
+                lines.append(self.list(depth + 1))
+        return '\n'.join(lines)
+
+    def table(self):
+        cols = self.rng.randint(2, 5)
+        rows = ['<tr>%s</tr>' % ''.join('<th>%s</th>' % self.words(1)
+                                        for _ in range(cols))]
+        for _ in range(self.rng.randint(2, 10)):
+            rows.append('<tr>%s</tr>' % ''.join(
+                '<td>%s</td>' % self.rng.randint(0, 1000)
+                for _ in range(cols)))
+        return '<table>\n%s\n</table>' % '\n'.join(rows)
+
+    def math(self):
+        inline = '$%s_%d = %s^2 + \\frac{1}{%d}$' % (
+            self.words(1)[0], self.rng.randint(0, 9), self.words(1)[0],
+            self.rng.randint(2, 99))
+        display = '$$\\sum_{i=0}^{%d} x_i \\leq %d$$' % (
+            self.rng.randint(1, 99), self.rng.randint(1, 999))
+        return '%s %s\n\n%s' % (self.sentence(), inline, display)
+
+    def footnote(self):
+        self.footnotes += 1
+        return '%s[^%d]\n\n[^%d]: %s' % (
+            self.sentence(), self.footnotes, self.footnotes, self.sentence())
+
+    def image(self):
+        return '![%s](figures/%s.png "%s")' % (
+            self.words(3), self.words(1), self.words(2))
+
+    def link(self):
+        return '%s [%s](http://example.com/%s/%d) %s' % (
+            self.sentence(), self.words(2), self.words(1),
+            self.rng.randint(0, 999), self.sentence())
+
+    def generate(self, size):
+        """Return a document of at least `size` characters."""
+        kinds = sorted(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        blocks = []
+        length = 0
+        while length < size:
+            kind = self.rng.choices(kinds, weights)[0]
+            blocks.append(getattr(self, kind)())
+            length += len(blocks[-1]) + 2
+        return '\n\n'.join(blocks)
+
+
+def corpus(size, seed=0, mix=None):
+    """Return a generated markdown document of at least `size` characters,
+    with blocks of each kind in `mix` (a dict of kind to weight)."""
+    return Corpus(seed, mix).generate(size)
+
+
+def run_stages(text, repeat=3, **configs):
+    """Convert text with an instrumented LaTeXConverter and return a dict of
+    results: the best time of `repeat` conversions for each stage, with the
+    throughput in MB of markdown a second, and the peak memory allocated in
+    one more conversion under tracemalloc."""
+    converter = mdx_latex.LaTeXConverter(**configs)
+    stats = converter.extension.instrument()
+    size = len(text.encode('utf-8'))
+    best = {}
+    for _ in range(repeat):
+        stats.reset()
+        converter.convert(text)
+        for name, stage in stats.stages.items():
+            best[name] = min(best.get(name, float('inf')), stage['seconds'])
+    stats.reset()
+    tracemalloc.start()
+    converter.convert(text)
+    tracemalloc.stop()
+    order = [name for name, stage in stats.stages.items() if stage['calls']]
+    stages = {}
+    for name in order:
+        secs = best[name]
+        stages[name] = {'seconds': secs,
+                        'mb_per_s': size / 1e6 / secs if secs else None,
+                        'peak_mb': stats.stages[name]['peak'] / 1e6}
+    return {'bytes': size, 'order': order, 'stages': stages}
+
+
+def bench_stages(size=1000000, seed=0, mix=None, output=None,
+                 compare=None):
+    """Each stage of converting a generated document of `size` characters.
+    Peak MB is the most memory allocated during the stage. With `output`
+    the results are saved there as JSON, and with `compare` they are shown
+    against those of an earlier run saved in that file."""
+    text = corpus(size, seed, mix)
+    results = run_stages(text)
+    results.update({'size': size, 'seed': seed, 'mix': mix or MIX,
+                    'python': platform.python_version(),
+                    'markdown': markdown.__version__})
+    old = None
+    if compare:
+        with open(compare) as fo:
+            old = json.load(fo)['stages']
+    print('%-26s %10s %10s %10s %10s' % ('stage', 'ms', 'MB/s', 'peak MB',
+                                         'vs old'))
+    for name in results['order']:
+        stage = results['stages'][name]
+        ratio = ''
+        if old and old.get(name, {}).get('seconds'):
+            ratio = '%.2fx' % (stage['seconds'] / old[name]['seconds'])
+        print('%-26s %10.2f %10s %10.1f %10s' % (
+            name, stage['seconds'] * 1e3,
+            '%.1f' % stage['mb_per_s'] if stage['mb_per_s'] else '-',
+            stage['peak_mb'], ratio))
+    if output:
+        with open(output, 'w') as fo:
+            json.dump(results, fo, indent=2, sort_keys=True)
+
+
+BENCHMARKS = {
+    'convert': bench_convert,
+    'escape': bench_escape,
+    'footnotes': bench_footnotes,
+    'incremental': bench_incremental,
+    'links': bench_links,
+    'math': bench_math,
+    'paper': bench_paper,
+    'pdflatex': bench_pdflatex,
+    'smarty': bench_smarty,
+    'stages': bench_stages,
+    'table': bench_table,
+    'tags': bench_tags,
+    'template': bench_template,
+    'tolatex': bench_tolatex,
+    'write': bench_write,
+}
+
+
+def parse_mix(option, opt, value, parser):
+    """Read a mix of blocks given as kind=weight,..."""
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in MIX or not weight.isdigit():
+            raise optparse.OptionValueError(
+                'option %s: expected kind=weight,... with kinds from %s, '
+                'got %r' % (opt, ', '.join(sorted(MIX)), item))
+        mix[kind] = int(weight)
+    setattr(parser.values, option.dest, mix)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [name ...]',
+        description='Run the named benchmarks, or all of them: %s.' %
+        ', '.join(sorted(BENCHMARKS)))
+    parser.add_option('-n', '--size', type='int', default=1000000,
+                      help='characters in the stages document '
+                      '[default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed for the stages document [default: %default]')
+    parser.add_option('-m', '--mix', type='string', action='callback',
+                      callback=parse_mix,
+                      help='kinds of block in the stages document as '
+                      'kind=weight,... [default: %s]' % ','.join(
+                          '%s=%s' % item for item in sorted(MIX.items())))
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='save the stages results to FILE as JSON')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='compare the stages results with those saved in '
+                      'FILE')
+    options, names = parser.parse_args(args)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('no benchmark called %r' % name)
+    kwargs = {'stages': {'size': options.size, 'seed': options.seed,
+                         'mix': options.mix, 'output': options.output,
+                         'compare': options.compare}}
+    for name in names or sorted(BENCHMARKS):
+        print('== %s ==' % name)
+        BENCHMARKS[name](**kwargs.get(name, {}))
+        print('')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,25 @@
+import http.server
+import io
+import os
+import stat
+import tempfile
+import threading
+import time
+import tracemalloc
+import xml.etree.ElementTree as etree
+
 import markdown
+import pytest
 import mdx_latex
 
+
+@pytest.fixture(autouse=True)
+def tempdir(tmp_path_factory, monkeypatch):
+    # the temporary files the code makes go where pytest cleans them up
+    monkeypatch.setattr(tempfile, 'tempdir',
+                        str(tmp_path_factory.mktemp('tempfile')))
+
+
 class TestMkdn2Latex:
 
     mkdn_input = \
@@ -109,11 +128,9 @@ Some mathematics inline, $X$, a \\$100 million, a \\%tage and then a formula:
 
 \\[ \\sum_{i}^{\\infty} x^{n} + y^{n} = \\alpha +  \\beta \cdot z^{n} \\]
 
-A paragraph with a\\footnote{a very dull footnote indeed
-
-but it does have mutiple paragraphs.} footnote in it\\footnote{a very dull footnote indeed
+A paragraph with a\\footnote{\\label{fn:fn1}a very dull footnote indeed
 
-but it does have mutiple paragraphs.}.
+but it does have mutiple paragraphs.} footnote in it\\footref{fn:fn1}.
 
 A table now (this is \\emph{really} complicated):
 
@@ -196,6 +213,50 @@ Now for ```Something a little' more complicated''. ``And again.''
         #    print ii
         #    assert out[ii] == self.exp1[ii]
 
+    def test_entities_and_quotes(self):
+        cases = [
+            ("&amp;lt;b&amp;gt; &amp;amp; &quot;'x'&quot;",
+             "<b> \\&amp; ```x'``"),
+            ('&amp;quot;\'a\' "b",', "```a' ``b'',"),
+            ("'&quot;", '```'),
+            ('50% #1 &lt;&gt;', '50\\% \\#1 <>'),
+            ('a"b" "c"\n', "a\"b'' ``c''\n"),
+        ]
+        for text, expected in cases:
+            assert mdx_latex.escape_latex_entities(text) == expected
+
+class TestInlineHtmlLatex:
+
+    def test_quotes(self):
+        cases = [
+            ('&ldquo;a&rdquo; and &ldquo;b&rdquo;',
+             '\\enquote{a} and \\enquote{b}'),
+            ('&ldquo;He said &lsquo;no&rsquo; to me&rdquo;',
+             '\\enquote{He said \\enquote{no} to me}'),
+            ('&lsquo;don&rsquo;t&rsquo;, it&rsquo;s', "\\enquote{don't}, it's"),
+            ('&ldquo;a&ldquo; b', '\\enquote{a} b'),
+            ('&laquo;a &lsquo;b&raquo; c&rsquo;',
+             "\\enquote{a `b} c'"),
+            ('&rdquo;a&ldquo;', "''a``"),
+            # double quotes in turn, with unpaired single quotes and
+            # other entities about
+            ('&ldquo;a&rdquo; it&rsquo;s &amp; &ldquo;b&rdquo; &lsquo;c',
+             "\\enquote{a} it's &amp; \\enquote{b} `c"),
+            ('&ldquo;a&rdquo; &ldquo;b&rdquo;&rdquo;',
+             "\\enquote{a} \\enquote{b}''"),
+            ('&lsquo;a&rsquo; &rsquo;', "\\enquote{a} '"),
+        ]
+        for text, expected in cases:
+            assert mdx_latex.inline_html_latex(text) == expected
+
+    def test_others(self):
+        out = mdx_latex.inline_html_latex(
+            'a... b&hellip; 1&ndash;2&mdash;3 x \\| y &amp;')
+        assert out == 'a\\dots b\\dots 1--2---3 x | y &amp;'
+        text = 'nothing to do here'
+        assert mdx_latex.inline_html_latex(text) is text
+
+
 class TestTable2Latex:
 
     intable1 = '''
@@ -239,6 +300,54 @@ class TestTable2Latex:
         print(ss)
         assert out == ss
 
+    def test_adjacent_cells(self):
+        out = mdx_latex.Table2Latex().convert(
+            '<table><tr><td>a</td><td>b</td></tr></table>')
+        assert '\na & b \\\\\n' in out
+        # a cell followed straight by another one, next to cells with
+        # whitespace between them, gets its & too (the minidom converter
+        # left it out, giving 'a b & c' and 'a & b & c d')
+        for row in ['<tr>\n<td>a</td><td>b</td>\n<td>c</td>\n</tr>',
+                    '<tr>\n<td>a</td>\n<td>b</td><td>c</td><td>d</td>\n</tr>']:
+            table = '<table>\n%s\n</table>' % row
+            latex = '\n%s \\\\\n' % ' & '.join('abcd'[:row.count('<td>')])
+            assert latex in mdx_latex.Table2Latex().convert(table)
+            element = etree.fromstring(table)
+            assert latex in mdx_latex.Table2Latex().convert_element(element)
+
+    def test_chunks(self):
+        rows = ''.join('<tr>\n<td>%d</td>\n<td>%d%%</td>\n</tr>\n' % (ii, ii)
+                       for ii in range(50))
+        table = '<table>\n<caption>Cap</caption>\n%s</table>' % rows
+        whole = mdx_latex.Table2Latex().convert(table)
+        converter = mdx_latex.Table2Latex()
+        converter.chunk_size = 7
+        assert converter.convert(table) == whole
+        assert whole.count('\\hline') == 51
+        assert '\\caption{Cap}' in whole
+
+    def test_longtable(self):
+        table = ('<table>\n<thead>\n<tr>\n<th>H</th>\n</tr>\n</thead>\n'
+                 '<tbody>\n%s</tbody>\n</table>' % (
+                     '<tr>\n<td>x</td>\n</tr>\n' * 3))
+        assert 'longtable' not in mdx_latex.Table2Latex().convert(table)
+        assert 'longtable' not in mdx_latex.Table2Latex(4).convert(table)
+        out = mdx_latex.Table2Latex(3).convert(table)
+        assert out.startswith('\n\\begin{longtable}{|l|}\n')
+        # the head is repeated on every page
+        head = '\\hline\n\\textbf{H} \\\\\n'
+        assert out.count(head) == 2
+        assert head + '\\endhead\n' in out
+        assert out.count('x \\\\') == 3
+        element = mdx_latex.etree.fromstring(table)
+        assert mdx_latex.Table2Latex(3).convert_element(element) == out
+
+
+LONE_DOLLAR = ('Some mathematics inline, $$X$$, a $100 million, a %tage and '
+               'then a formula:\n\n$$ \\sum_{i}^{\\infty} x^{n} + y^{n} = '
+               '\\alpha +  \\beta * z^{n} $$')
+
+
 class TestMathConvert:
 
     intext = '''
@@ -277,6 +386,22 @@ W & = & y + z \\\\
         print(out)
         assert out == self.outtext
 
+    def test_fixes_inside_math_only(self):
+        converter = mdx_latex.MathTextPostProcessor()
+        out = converter.run('2 * 3 \\lt 7 but $a * b \\lt c$ and '
+                            '$$\\del x$$')
+        assert out == ('2 * 3 \\lt 7 but \\(a \\cdot b < c\\) and '
+                       '\\[\\partial x\\]')
+
+    def test_lone_dollar(self):
+        # a lone dollar does not pair with the first one of a later $$
+        out = mdx_latex.MathTextPostProcessor().run(LONE_DOLLAR)
+        assert out == ('Some mathematics inline, \\[X\\], a $100 million, '
+                       'a %tage and then a formula:\n\n'
+                       '\\[ \\sum_{i}^{\\infty} x^{n} + y^{n} = '
+                       '\\alpha +  \\beta \\cdot z^{n} \\]')
+
+
 class TestImgConvert:
 
     intext = '''
@@ -296,3 +421,938 @@ class TestImgConvert:
         out = converter.convert(self.intext)
         print(out)
         assert out == self.exp1
+
+class TestStripFragments:
+
+    def test_1(self):
+        for frags in [[' \n', '', ' a ', 'b', ' ', '\n'], ['  ', ' '], [],
+                      ['x'], ['', ' x y ', '']]:
+            out = list(frags)
+            mdx_latex.strip_fragments(out)
+            assert ''.join(out) == ''.join(frags).strip()
+
+class TestDeepNesting:
+
+    depth = 5000
+
+    def test_tree(self):
+        root = mdx_latex.etree.Element('div')
+        node = root
+        for ii in range(self.depth):
+            node = mdx_latex.etree.SubElement(node, 'blockquote')
+        node.text = 'deep'
+        out = mdx_latex.LaTeXTreeProcessor().tolatex(root)
+        assert out.count('\\begin{quotation}') == self.depth
+        assert 'deep' in out
+
+    def test_table(self):
+        cell = '<span>' * self.depth + 'deep' + '</span>' * self.depth
+        table = '<table><tr><td>%s</td> <td>x</td> </tr></table>' % cell
+        out = mdx_latex.Table2Latex().convert(table)
+        assert 'deep & x' in out
+
+class TestLaTeXTextPostProcessor:
+
+    intext = '''Some &ldquo;text&rdquo; with $x$ in it...
+
+<img src="blah.png" alt="abc abc" />
+
+<table>
+<tr>
+<td>1.0</td> <td>2.0</td>
+</tr>
+</table>
+
+
+See <a href="http://example.com/">the example</a> for $$y$$.
+'''
+
+    def test_same_as_separate_processors(self):
+        out = self.intext
+        for processor in [mdx_latex.UnescapeHtmlTextPostProcessor(),
+                          mdx_latex.MathTextPostProcessor(),
+                          mdx_latex.ImageTextPostProcessor(),
+                          mdx_latex.TableTextPostProcessor(),
+                          mdx_latex.LinkTextPostProcessor()]:
+            out = processor.run(out)
+        assert mdx_latex.LaTeXTextPostProcessor().run(self.intext) == out
+
+    def test_no_wrapper_element(self):
+        md = markdown.Markdown()
+        mdx_latex.LaTeXExtension().extendMarkdown(md)
+        out = md.convert('![abc](blah.png)\n\nsome text')
+        assert out.startswith('\\begin{figure}')
+        assert out.endswith('some text')
+
+    def test_img_with_text(self):
+        block = '<img src="a.png" alt="x"/> and text'
+        assert mdx_latex.LaTeXTextPostProcessor().run(block) == block
+        out = mdx_latex.LaTeXConverter().convert(block)
+        assert out == block
+
+
+class TestEmitters:
+
+    def test_register(self):
+        converter = mdx_latex.LaTeXConverter()
+        extension = converter.extension
+        extension.register_emitter(
+            'h5', mdx_latex.wrapper('\n\\paragraph{', '}\n'))
+        extension.register_emitter('code', mdx_latex.wrapper('\\texttt{', '}'))
+        extension.register_emitter('hr', mdx_latex.replacer('\\newpage'))
+        extension.register_emitter('em', None)
+        out = converter.convert('##### Five\n\nSome `code` and *em*.\n\n---')
+        assert out == ('\\paragraph{Five}\n\nSome \\texttt{code} and em.'
+                       '\n\\newpage')
+        # the defaults are left alone
+        out = mdx_latex.LaTeXConverter().convert('Some *em*.')
+        assert out == 'Some \\emph{em}.'
+
+    def test_emitter_arguments(self):
+        def emit_dl(processor, ournode, out, start):
+            items = ['\\item[%s]' % processor.content_latex(child)
+                     if child.tag == 'dt' else processor.content_latex(child)
+                     for child in ournode]
+            mdx_latex.replace_fragments(out, start, '\\begin{description}%s'
+                                        '\\end{description}' % ''.join(items))
+
+        processor = mdx_latex.LaTeXTreeProcessor(
+            emitters=dict(mdx_latex.LaTeXTreeProcessor.default_emitters,
+                          dl=emit_dl))
+        tree = etree.fromstring(
+            '<div><dl><dt>term</dt><dd>def <em>x</em></dd></dl> tail</div>')
+        assert processor.tolatex(tree) == (
+            '\\begin{description}\\item[term]def \\emph{x}'
+            '\\end{description} tail')
+
+    def test_skip_children(self):
+        left = []
+
+        def emit_svg(processor, ournode, out, start):
+            mdx_latex.replace_fragments(out, start, '\\includesvg{%s}'
+                                        % ournode.get('id'))
+        emit_svg.skip_children = True
+
+        def emit_em(processor, ournode, out, start):
+            left.append(ournode.text)
+
+        processor = mdx_latex.LaTeXTreeProcessor(
+            emitters=dict(mdx_latex.LaTeXTreeProcessor.default_emitters,
+                          svg=emit_svg, em=emit_em))
+        tree = etree.fromstring('<div><svg id="a"><em>x</em></svg> and '
+                                '<em>y</em></div>')
+        assert processor.tolatex(tree) == '\\includesvg{a} and y'
+        assert left == ['y']
+
+
+class TestLinkTextPostProcessor:
+
+    def test_links(self):
+        block = ('See <a href="http://a.org/">http://a.org/</a>, '
+                 '<a href="http://b.org/?x=1&amp;y=2">b</a> and '
+                 '<a href="http://a.org/">http://a.org/</a>.\n')
+        out = mdx_latex.LinkTextPostProcessor().process_block(block)
+        assert out == ('See \\url{http://a.org/}, '
+                       '\\href{http://b.org/?x=1&y=2}{b} and '
+                       '\\url{http://a.org/}.')
+
+    def test_replacement_literal(self):
+        block = '<a href="http://a.org/\\d\\1">x \\2</a>'
+        out = mdx_latex.LinkTextPostProcessor().process_block(block)
+        assert out == '\\href{http://a.org/\\d\\1}{x \\2}'
+
+    def test_bad_anchor(self):
+        block = 'A <a href=u>bad</a> and a <a href="u">good</a> link'
+        out = mdx_latex.LinkTextPostProcessor().process_block(block)
+        assert out == 'A <a href=u>bad</a> and a \\href{u}{good} link'
+        mdx_latex.LaTeXConverter().convert(block)
+
+    def test_ampersand_in_href(self):
+        out = mdx_latex.LaTeXConverter().convert(
+            'A <a href="http://x.org/?a=1&amp;b=2">raw</a> link.')
+        assert out == 'A \\href{http://x.org/?a=1&b=2}{raw} link.'
+
+    def test_no_links(self):
+        block = ' <b>text</b> '
+        assert mdx_latex.LinkTextPostProcessor().process_block(block) is block
+
+
+class TestElementConversion:
+
+    intext = '''Some text with ![a 50% pic](pic.png) in it, [a *link*](http://x.org/)
+and <http://y.org/>.
+
+| Head | Two |
+|------|-----|
+| 1%   | 2   |
+'''
+
+    def test_1(self):
+        md = markdown.Markdown(extensions=['tables'])
+        mdx_latex.LaTeXExtension().extendMarkdown(md)
+        out = md.convert(self.intext)
+        assert '<' not in out
+        # inline, so not a figure
+        assert ('Some text with \\includegraphics[max width=\\linewidth]'
+                '{pic.png} in it' in out)
+        assert '\\begin{figure}' not in out
+        assert '\\href{http://x.org/}{a \\emph{link}}' in out
+        assert '\\url{http://y.org/}' in out
+        assert '\\textbf{Head} & \\textbf{Two} \\\\' in out
+        assert '\n1\\% & 2 \\\\\n' in out
+
+    def test_inline_img(self):
+        out = mdx_latex.LaTeXConverter().convert(
+            '![own](a.png)\n\n[![link](b.png)](http://x.org/) '
+            '*![em](c.png)*\n\n| Head |\n|------|\n| ![cell](d.png) |')
+        assert out.count('\\begin{figure}') == 1
+        assert '\\caption{own}' in out
+        assert ('\\href{http://x.org/}{\\includegraphics[max width='
+                '\\linewidth]{b.png}} \\emph{\\includegraphics[max width='
+                '\\linewidth]{c.png}}' in out)
+        assert '\\includegraphics[max width=\\linewidth]{d.png}' in out
+
+    def test_raw_table(self):
+        md = markdown.Markdown()
+        mdx_latex.LaTeXExtension().extendMarkdown(md)
+        table = ('<table>\n<tr><th>A &amp; B</th><th>C</th></tr>\n'
+                 '<tr><td>x%sy</td><td>z</td></tr>\n</table>')
+        out = md.convert('Before.\n\n%s\n\nAfter.' % (table % ''))
+        assert '\\textbf{A \\& B} & \\textbf{C} \\\\' in out
+        assert '\nxy & z \\\\\n' in out
+        # a <br> does not parse, so the table is left as it is
+        out = md.convert('Before.\n\n%s\n\nAfter.' % (table % '<br>'))
+        assert '<td>x<br>y</td>' in out
+        assert out.startswith('Before.') and out.endswith('After.')
+
+    def test_table_element(self):
+        table = mdx_latex.etree.fromstring(TestTable2Latex.intable1)
+        out = mdx_latex.Table2Latex().convert_element(table)
+        assert '\\multicolumn{3}{|c|}{\\textbf{Heading 1}} & ' in out
+        assert '\\begin{tabular}{|l|l|l|l|}' in out
+        assert '\\caption{My Caption}' in out
+
+
+class TestFootnotePreprocessor:
+
+    def run(self, lines):
+        footnotes = mdx_latex.FootnoteExtension()
+        lines = mdx_latex.FootnotePreprocessor(footnotes).run(lines)
+        return lines, footnotes
+
+    def test_definitions(self):
+        lines, footnotes = self.run([
+            'Text[^b] and[^a].', '',
+            '[^a]: first line', '    more', '', '    second para', '',
+            'Plain text.', '[^b]: other', 'Not indented.'])
+        assert lines == ['Text[^b] and[^a].', '', '', 'Plain text.', '',
+                         'Not indented.']
+        assert footnotes.footnotes == {
+            'a': 'first line\nmore\n\nsecond para', 'b': 'other\n'}
+        assert footnotes.used_footnotes == {'b': 1, 'a': 2}
+
+    def test_many_footnotes(self):
+        lines = []
+        for ii in range(5000):
+            lines.extend(['Text[^%d].' % ii, '', '[^%d]: note' % ii, ''])
+        lines, footnotes = self.run(lines)
+        assert len(footnotes.footnotes) == 5000
+        assert footnotes.used_footnotes['4999'] == 5000
+
+
+class TestFootnotes:
+
+    text = """Some text[^a] and more[^b] and again[^a], not[^none].
+
+[^a]: A *note* with $x_1$.
+
+    And a second paragraph.
+
+[^b]: Short.
+"""
+
+    def test_footnotes(self):
+        out = mdx_latex.LaTeXConverter().convert(self.text)
+        assert out == (
+            'Some text\\footnote{\\label{fn:a}A \\emph{note} with \\(x_1\\).'
+            '\n\nAnd a second paragraph.} and more\\footnote{Short.} and '
+            'again\\footref{fn:a}, not[^none].')
+
+    def test_parsed_once(self):
+        converter = mdx_latex.LaTeXConverter()
+        converter.convert(self.text)
+        footnotes = converter.extension.footnotes
+        div = footnotes.footnoteElement('a')
+        assert footnotes.footnoteElement('a') is div
+        # nothing is kept from one document to the next
+        assert converter.convert('Text[^a].') == 'Text[^a].'
+        assert footnotes.elements == {}
+
+
+class TestLaTeXConverter:
+
+    def fresh(self, text):
+        md = markdown.Markdown()
+        mdx_latex.LaTeXExtension().extendMarkdown(md)
+        return md.convert(text)
+
+    def test_same_as_fresh(self):
+        converter = mdx_latex.LaTeXConverter()
+        texts = ['# Title\n\nSome *text* & $x$.',
+                 '* one\n* two\n\n> quoted',
+                 'A [link](http://example.com/) and <b>html</b>.']
+        for text in texts + texts:
+            assert converter.convert(text) == self.fresh(text)
+
+    def test_reset_between_documents(self):
+        converter = mdx_latex.LaTeXConverter()
+        converter.convert('[a]: http://example.com/\n\n<div>stashed</div>')
+        text = 'A [link][a].'
+        assert converter.convert(text) == self.fresh(text)
+
+    def test_convert_to(self):
+        converter = mdx_latex.LaTeXConverter()
+        text = ('  \n# Title\n\nSome *text* & $x$.\n\n'
+                '<table>\n<tr>\n<td>$y$</td>\n</tr>\n</table>\n\n'
+                '    code\n\n')
+        for tmpl in [None, 'head\nINSERT-TEXT-HERE\ntail\n', 'no text',
+                     'INSERT-TEXT-HERE and again INSERT-TEXT-HERE']:
+            out = io.StringIO()
+            converter.convert_to(text, out, tmpl)
+            latex = converter.convert(text)
+            if tmpl is not None:
+                latex = mdx_latex.template(io.StringIO(tmpl), latex)
+            assert out.getvalue() == latex
+
+    def test_postprocessor_after_latex(self):
+        class Shout(markdown.postprocessors.Postprocessor):
+            def run(self, text):
+                return text.upper()
+
+        converter = mdx_latex.LaTeXConverter()
+        converter.md.postprocessors.register(Shout(), 'shout', 10)
+        text = 'Some *text*.\n\nMore.'
+        out = ''.join(converter.fragments(text)).strip()
+        assert out == converter.convert(text) == 'SOME \\EMPH{TEXT}.\n\nMORE.'
+
+    def test_iter_stripped(self):
+        for fragments in [['  ', '\n', 'a ', ' ', 'b', '\n\n', ' '],
+                          ['', ' a\n', '\n\n', 'b '], [' ', ''], []]:
+            out = ''.join(mdx_latex.iter_stripped(iter(fragments)))
+            assert out == ''.join(fragments).strip()
+
+
+class TestConversionStats:
+
+    text = ('# Title\n\nSome *text* & $x$ and a [link](http://example.com/).'
+            '\n\n<table>\n<tr>\n<td>$y$</td>\n</tr>\n</table>\n')
+
+    def test_stages(self):
+        converter = mdx_latex.LaTeXConverter()
+        stats = converter.extension.instrument()
+        assert converter.extension.instrument() is stats
+        out = converter.convert(self.text)
+        assert out == mdx_latex.LaTeXConverter().convert(self.text)
+        stages = stats.stages
+        assert list(stages)[:3] == ['convert', 'pre:normalize_whitespace',
+                                    'pre:latex_math']
+        assert stages['convert']['calls'] == 1
+        assert stages['convert']['chars_in'] == len(self.text)
+        assert stages['convert']['chars_out'] == len(out)
+        assert stages['post:latex']['chars_out'] == len(out)
+        for name in ['parse', 'tree:latex', 'post:latex:math',
+                     'post:latex:table', 'post:latex:link']:
+            assert stages[name]['calls'] >= 1
+            assert stages[name]['seconds'] > 0
+        assert 'post:latex:table' in stats.summary()
+        stats.reset()
+        assert stages['convert']['calls'] == 0
+        tracemalloc.start()
+        converter.convert(self.text)
+        tracemalloc.stop()
+        assert stages['convert']['calls'] == 1
+        assert stages['convert']['peak'] >= stages['tree:latex']['peak'] > 0
+
+    def test_stage_names(self):
+        converter = mdx_latex.LaTeXConverter()
+        stats = converter.extension.instrument()
+        # the names read from each registry are those its processors are
+        # registered under, in the order they run
+        for kind, registry in [('pre', converter.md.preprocessors),
+                               ('tree', converter.md.treeprocessors),
+                               ('post', converter.md.postprocessors)]:
+            names = [stage.split(':')[1] for stage in stats.stages
+                     if stage.startswith(kind + ':') and stage.count(':') == 1]
+            assert [registry.get_index_for_name(name) for name in names] == \
+                list(range(len(registry)))
+
+    def test_instrument_before_extend(self):
+        extension = mdx_latex.LaTeXExtension()
+        stats = extension.instrument()
+        md = markdown.Markdown(extensions=[extension])
+        md.convert(self.text)
+        assert stats.stages['tree:latex']['calls'] == 1
+
+    def test_off_by_default(self):
+        converter = mdx_latex.LaTeXConverter()
+        converter.convert(self.text)
+        assert converter.extension.stats is None
+        assert 'run' not in vars(converter.md.treeprocessors['latex'])
+
+
+class TestTemplate:
+
+    text = ('\\title{INSERT-TITLE-HERE}\n\\author{INSERT-AUTHOR-HERE}\n'
+            'INSERT-TEXT-HERE\n\\end{document}\n')
+
+    def test_render(self):
+        tmpl = mdx_latex.Template(self.text)
+        out = tmpl.render('Body', title='A title', author='')
+        assert out == '\\title{A title}\n\\author{}\nBody\n\\end{document}\n'
+        # slots not given are kept
+        out = tmpl.render('Body', title='A title')
+        assert '\\author{INSERT-AUTHOR-HERE}' in out
+
+    def test_same_as_replace(self):
+        for text in ['no slots', 'INSERT-TEXT-HERE', 'a INSERT-TEXT-HERE b',
+                     'INSERT-TEXT-HERE, INSERT-TEXT-HERE',
+                     'INSERT-BODY-HERE INSERT-TEXT-HERE INSERT-FOO-HERE']:
+            out = mdx_latex.template(io.StringIO(text), 'latex')
+            assert out == text.replace('INSERT-TEXT-HERE', 'latex')
+
+    def test_fill(self):
+        tmpl = mdx_latex.Template(self.text)
+        filled = tmpl.fill(title='T', author='A')
+        assert filled.parts[1::2] == ['text']
+        assert filled.render('B') == tmpl.render('B', title='T', author='A')
+        assert tmpl.parts[1::2] == ['title', 'author', 'text']
+
+    def test_write(self):
+        tmpl = mdx_latex.Template(self.text)
+        out = io.StringIO()
+        tmpl.write(out, iter(['Bo', 'dy']), author='Me')
+        assert out.getvalue() == tmpl.render('Body', author='Me')
+        assert 'INSERT-TITLE-HERE' in out.getvalue()
+        out = io.StringIO()
+        mdx_latex.Template('INSERT-TEXT-HERE INSERT-TEXT-HERE').write(
+            out, iter(['a', 'b']))
+        assert out.getvalue() == 'ab ab'
+
+    def test_load_template(self, tmp_path):
+        path = str(tmp_path / 'template.tex')
+        with open(path, 'w') as fo:
+            fo.write('one INSERT-TEXT-HERE')
+        tmpl = mdx_latex.load_template(path)
+        assert mdx_latex.load_template(path) is tmpl
+        with open(path, 'w') as fo:
+            fo.write('two INSERT-TEXT-HERE')
+        # the same size, so make sure the time differs
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert mdx_latex.load_template(path).render('x') == 'two x'
+
+
+class TestMathProtection:
+
+    def convert(self, text):
+        return mdx_latex.LaTeXConverter().convert(text)
+
+    def test_math_verbatim(self):
+        out = self.convert('Let $a_1 * b_2 \\lt 50\\%$ & "so".\n\n'
+                           '$$\nx_1 & y_2 \\\\\n$$')
+        assert out == ('Let \\(a_1 \\cdot b_2 < 50\\%\\) \\& ``so\'\'.\n\n'
+                       '\\[\nx_1 & y_2 \\\\\n\\]')
+
+    def test_code_verbatim(self):
+        out = self.convert('    echo "$HOME" 100% ... & done\n\n'
+                           'Inline `$PATH` and $x$.')
+        assert out == ('\\begin{verbatim}\necho "$HOME" 100% ... & done\n'
+                       '\\end{verbatim}\n\nInline $PATH and \\(x\\).')
+
+    def test_lone_dollar(self):
+        out = self.convert(LONE_DOLLAR)
+        assert out.startswith('Some mathematics inline, \\[X\\], a $100 '
+                              'million, a \\%tage')
+        assert out.endswith('\n\n\\[ \\sum_{i}^{\\infty} x^{n} + y^{n} = '
+                            '\\alpha +  \\beta \\cdot z^{n} \\]')
+
+    def test_math_in_lists(self):
+        out = self.convert('* a\n    * nested $x*y*z$ and $50\\%$\n\n'
+                           '* b\n\n    carried on $x*y$\n\n'
+                           'Text\n\n    code $x*y$')
+        assert '\\item nested \\(x*y*z\\) and \\(50\\%\\)' in out
+        assert '\ncarried on \\(x*y\\)\n' in out
+        assert out.endswith('\\begin{verbatim}\ncode $x*y$\n\\end{verbatim}')
+
+    def test_math_in_html(self):
+        out = self.convert('<table>\n<tr>\n<td>$x$</td>\n</tr>\n</table>')
+        assert '\\(x\\)' in out
+        assert '\x02' not in out
+
+
+class TestIncrementalConverter:
+
+    text = '''# Book
+
+Some [text][ref] and $x$.
+
+* one
+* two
+
+* three
+
+```
+code
+
+more
+```
+
+Last paragraph.
+
+[ref]: http://example.com/
+'''
+
+    def test_same_as_whole(self):
+        out = mdx_latex.IncrementalConverter().convert(self.text)
+        whole = mdx_latex.LaTeXConverter().convert(self.text)
+        assert out == whole
+
+    @pytest.mark.parametrize('text', [
+        TestMkdn2Latex.mkdn_input,
+        TestMathConvert.intext,
+        TestLaTeXTextPostProcessor.intext,
+        TestElementConversion.intext,
+        TestFootnotes.text,
+        'Text[^a].\n\n[^a]: note\n    \nNext.',
+        'One\n\n---\n\nTwo\n\n* a\n\n    * nested\n  \nEnd.',
+    ])
+    def test_same_as_whole_golden(self, text):
+        out = mdx_latex.IncrementalConverter().convert(text)
+        assert out == mdx_latex.LaTeXConverter().convert(text)
+
+    def test_convert_to(self):
+        converter = mdx_latex.IncrementalConverter()
+        out = io.StringIO()
+        converter.convert_to(self.text, out, 'INSERT-TEXT-HERE\n')
+        assert out.getvalue() == converter.convert(self.text) + '\n'
+        assert converter.reconverted == 0
+
+    def test_blocks(self):
+        blocks, definitions = mdx_latex.split_blocks(self.text)
+        assert len(blocks) == 5
+        assert blocks[2] == '* one\n* two\n\n* three'
+        assert blocks[3] == '```\ncode\n\nmore\n```'
+        assert definitions == ['[ref]: http://example.com/']
+
+    def test_footnote_blocks(self):
+        text = ('Text[^a].\n[^a]: note\n    more\n\n    again\nNext.\n\n'
+                'Other[^a].')
+        blocks, definitions = mdx_latex.split_blocks(text)
+        assert blocks == ['Text[^a].', 'Next.', 'Other[^a].']
+        assert definitions == ['[^a]: note\n    more\n\n    again']
+
+    def test_footnote_used_twice(self):
+        text = ('One[^a] and[^b].\n\nTwo[^a].\n\n'
+                '[^a]: first line\n[^b]: other\n')
+        converter = mdx_latex.IncrementalConverter()
+        whole = mdx_latex.LaTeXConverter().convert(text)
+        assert '\\footref{fn:a}' in whole
+        assert converter.convert(text) == whole
+        # a block's footnotes change when another block stops using them
+        out = converter.convert(text.replace('Two[^a]', 'Two'))
+        assert out == mdx_latex.LaTeXConverter().convert(
+            text.replace('Two[^a]', 'Two'))
+        assert '\\label' not in out
+
+    def test_only_changes_reconverted(self):
+        converter = mdx_latex.IncrementalConverter()
+        converter.convert(self.text)
+        assert converter.reconverted == 5
+        out = converter.convert(self.text.replace('Last', 'Final'))
+        assert converter.reconverted == 1
+        assert 'Final paragraph.' in out
+        # the block using a reference is converted again when it changes
+        out = converter.convert(self.text.replace('example.com', 'x.org'))
+        assert converter.reconverted == 1
+        assert '\\href{http://x.org/}{text}' in out
+
+    def test_disk_cache(self, tmp_path):
+        cache_dir = str(tmp_path)
+        first = mdx_latex.IncrementalConverter(
+            cache=mdx_latex.BlockCache(cache_dir))
+        out = first.convert(self.text)
+        second = mdx_latex.IncrementalConverter(
+            cache=mdx_latex.BlockCache(cache_dir))
+        assert second.convert(self.text) == out
+        assert second.reconverted == 0
+
+    def test_lru(self, tmp_path):
+        cache_dir = str(tmp_path)
+        cache = mdx_latex.BlockCache(cache_dir, max_entries=2)
+        for key in 'abc':
+            cache.put(key, key)
+        cache.evict()
+        assert list(cache.entries) == ['b', 'c']
+        assert len(os.listdir(cache_dir)) == 2
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+class TestWatcher:
+
+    @pytest.fixture(autouse=True)
+    def watch(self, tmp_path):
+        self.dir = str(tmp_path)
+        self.inpath = os.path.join(self.dir, 'doc.md')
+        self.outpath = os.path.join(self.dir, 'doc.tex')
+        self.write('First *version*.')
+        self.watcher = mdx_latex.Watcher(
+            self.inpath, self.outpath, mdx_latex.IncrementalConverter(),
+            interval=0.01, debounce=0.05)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.watcher.run,
+                                       args=(self.stop,))
+        self.thread.start()
+        yield
+        self.stop.set()
+        self.thread.join()
+
+    def write(self, text):
+        with open(self.inpath, 'w') as fo:
+            fo.write(text)
+
+    def read(self):
+        with open(self.outpath) as fo:
+            return fo.read()
+
+    def test_rebuilds(self):
+        wait_for(lambda: self.watcher.builds == 1)
+        assert self.read() == 'First \\emph{version}.\n'
+        self.write('Second version.')
+        wait_for(lambda: self.watcher.builds == 2)
+        assert self.read() == 'Second version.\n'
+
+    def test_only_on_new_content(self):
+        wait_for(lambda: self.watcher.builds == 1)
+        # saved again unchanged
+        os.utime(self.inpath, (0, 0))
+        self.write('First *version*.')
+        time.sleep(0.3)
+        assert self.watcher.builds == 1
+
+
+class ImageServer:
+    """Serve some images over HTTP/1.1 from a background thread, recording
+    the requests made, the client ports they came from and the status
+    returned. Images carry an ETag and If-None-Match is honoured, and paths
+    in redirects are redirected to the path they map to."""
+
+    def __init__(self, images, redirects={}):
+        self.images = images
+        self.redirects = redirects
+        self.requests = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                self.respond(False)
+
+            def do_GET(self):
+                self.respond(True)
+
+            def respond(self, body):
+                data = server.images.get(self.path)
+                etag = data is not None and '"%x"' % hash(data)
+                if self.path in server.redirects:
+                    status = 302
+                elif data is None:
+                    status = 404
+                elif self.headers.get('If-None-Match') == etag:
+                    status = 304
+                else:
+                    status = 200
+                server.requests.append((self.command, self.path,
+                                        self.client_address[1], status))
+                if status != 200:
+                    self.send_response(status)
+                    if status == 302:
+                        self.send_header('Location',
+                                         server.redirects[self.path])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                if body:
+                    self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.httpd.server_port, path)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestImageFetcher:
+
+    def setup_method(self):
+        self.images = dict(('/img/%s.png' % ii, b'png data %d' % ii)
+                           for ii in range(8))
+        self.server = ImageServer(self.images, {'/moved.png': '/img/0.png'})
+
+    def teardown_method(self):
+        self.server.stop()
+
+    def test_prefetch(self):
+        fetcher = mdx_latex.ImageFetcher(max_workers=3)
+        urls = [self.server.url(path) for path in sorted(self.images)]
+        fetcher.prefetch(urls + urls)
+        for url, path in zip(urls, sorted(self.images)):
+            filename = fetcher.fetch(url)
+            with open(filename, 'rb') as fo:
+                assert fo.read() == self.images[path]
+        fetcher.close()
+        # one GET per image and nothing else
+        assert [req[0] for req in self.server.requests] == ['GET'] * len(urls)
+        # connections are kept alive and reused
+        assert len(set(req[2] for req in self.server.requests)) <= 3
+
+    def test_missing(self):
+        fetcher = mdx_latex.ImageFetcher()
+        url = self.server.url('/nothing.png')
+        assert fetcher.fetch(url) == url
+        assert fetcher.fetch('local.png') == 'local.png'
+
+    def test_filename(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        fetcher = mdx_latex.ImageFetcher(max_size=10)
+        self.images['/img/1.png?size=large'] = b'large png'
+        path = fetcher.fetch(self.server.url('/img/1.png?size=large'))
+        assert os.path.basename(path) == '1.png'
+        self.images['/'] = b'root'
+        assert os.path.basename(fetcher.fetch(self.server.url('/'))) == \
+            'image'
+        # nothing is left behind by a failed download
+        self.images['/big.png'] = b'x' * 11
+        before = sorted(os.listdir(tempfile.tempdir))
+        url = self.server.url('/big.png')
+        assert fetcher.fetch(url) == url
+        assert sorted(os.listdir(tempfile.tempdir)) == before
+
+    def test_redirect(self):
+        fetcher = mdx_latex.ImageFetcher()
+        with open(fetcher.fetch(self.server.url('/moved.png')), 'rb') as fo:
+            assert fo.read() == self.images['/img/0.png']
+        assert [req[3] for req in self.server.requests] == [302, 200]
+
+    def test_max_size(self):
+        self.images['/big.png'] = b'x' * 100
+        fetcher = mdx_latex.ImageFetcher(max_size=99)
+        url = self.server.url('/big.png')
+        assert fetcher.fetch(url) == url
+        fetcher = mdx_latex.ImageFetcher(max_size=100)
+        assert fetcher.fetch(url) != url
+
+    def test_in_document_order(self):
+        md = markdown.Markdown()
+        mdx_latex.LaTeXExtension(image_workers=4).extendMarkdown(md)
+        paths = sorted(self.images)
+        text = '\n\n'.join('![%s](%s)' % (path, self.server.url(path))
+                            for path in paths)
+        out = md.convert(text)
+        captions = [line.strip() for line in out.split('\n')
+                    if '\\caption' in line]
+        assert captions == ['\\caption{%s}' % path for path in paths]
+        assert self.server.url('') not in out
+
+    def convert_cached(self, cache_dir, paths):
+        md = markdown.Markdown()
+        mdx_latex.LaTeXExtension(image_cache_dir=cache_dir).extendMarkdown(md)
+        return md.convert('\n\n'.join('![](%s)' % self.server.url(path)
+                                       for path in paths))
+
+    def test_cache_revalidates(self, tmp_path):
+        cache_dir = str(tmp_path)
+        paths = sorted(self.images)
+        out = self.convert_cached(cache_dir, paths)
+        del self.server.requests[:]
+        # a rebuild makes conditional requests only
+        assert self.convert_cached(cache_dir, paths) == out
+        assert [req[3] for req in self.server.requests] == [304] * len(paths)
+        # and a changed image is downloaded again
+        self.images[paths[0]] = b'new png data'
+        del self.server.requests[:]
+        out = self.convert_cached(cache_dir, paths[:1])
+        assert [req[3] for req in self.server.requests] == [200]
+        filename = out.split('\\includegraphics[max width=\\linewidth]{')[1]
+        with open(filename.split('}')[0], 'rb') as fo:
+            assert fo.read() == b'new png data'
+
+    def test_stats(self, tmp_path):
+        converter = mdx_latex.LaTeXConverter(image_cache_dir=str(tmp_path))
+        stats = converter.extension.instrument()
+        urls = [self.server.url(path) for path in ['/img/0.png', '/none.png']]
+        text = '\n\n'.join('![](%s)' % url for url in urls + urls)
+        converter.convert(text)
+        assert [stats.images[url]['outcome'] for url in urls] == [
+            'downloaded', 'failed']
+        assert [stats.images[url]['hits'] for url in urls] == [1, 1]
+        # a new converter, sharing the cache, only revalidates
+        converter = mdx_latex.LaTeXConverter(
+            image_cache_dir=converter.extension.getConfig('image_cache_dir'))
+        stats = converter.extension.instrument()
+        converter.convert(text)
+        converter.convert(text)
+        assert stats.images[urls[0]]['outcome'] == 'revalidated'
+        assert stats.images[urls[0]]['hits'] == 2
+        assert 'revalidated' in stats.summary()
+
+    def test_retried_next_document(self):
+        converter = mdx_latex.LaTeXConverter()
+        url = self.server.url('/later.png')
+        text = '![](%s)' % url
+        assert url in converter.convert(text)
+        self.images['/later.png'] = b'png data'
+        assert url not in converter.convert(text)
+
+    def test_cache_eviction(self, tmp_path):
+        cache = mdx_latex.ImageCache(str(tmp_path), max_size=30)
+        fetcher = mdx_latex.ImageFetcher(cache=cache)
+        urls = [self.server.url(path) for path in sorted(self.images)]
+        for ii, url in enumerate(urls[:4]):
+            fetcher.fetch(url)
+            # mtimes order the entries by last use
+            os.utime(os.path.join(cache.directory, cache.key(url) + '.json'),
+                     (ii, ii))
+        # a new cache reads the entries from the directory
+        cache = mdx_latex.ImageCache(cache.directory, max_size=30)
+        cache.evict()
+        # each image is 10 bytes, so only the last three used are kept
+        assert [cache.lookup(url) is not None for url in urls[:4]] == \
+            [False, True, True, True]
+        assert cache.total == 30
+
+    def test_cache_keeps_images_in_use(self, tmp_path):
+        cache = mdx_latex.ImageCache(str(tmp_path), max_size=30)
+        fetcher = mdx_latex.ImageFetcher(cache=cache)
+        urls = [self.server.url(path) for path in sorted(self.images)]
+        for url in urls[:4]:
+            fetcher.fetch(url)
+        # the document still needs all four, so none is evicted
+        assert all(cache.lookup(url) is not None for url in urls[:4])
+        assert cache.total == 40
+        fetcher.forget()
+        fetcher.fetch(urls[3])
+        cache.evict()
+        assert [cache.lookup(url) is not None for url in urls[:4]] == \
+            [False, True, True, True]
+        assert cache.total == 30
+
+
+class TestBatch:
+
+    @pytest.fixture(autouse=True)
+    def files(self, tmp_path):
+        self.tmp = str(tmp_path)
+        self.indir = os.path.join(self.tmp, 'in')
+        self.outdir = os.path.join(self.tmp, 'out')
+        os.makedirs(os.path.join(self.indir, 'part'))
+        os.mkdir(self.outdir)
+        self.texts = {
+            'one.md': '# One\n\nSome *text*.',
+            os.path.join('part', 'two.md'): 'Two & more.',
+            os.path.join('part', 'three.markdown'): '> quoted',
+        }
+        for name, text in self.texts.items():
+            with open(os.path.join(self.indir, name), 'w') as fo:
+                fo.write(text)
+        with open(os.path.join(self.indir, 'notes.tex'), 'w') as fo:
+            fo.write('not markdown')
+
+    def expected(self, text):
+        md = markdown.Markdown()
+        mdx_latex.LaTeXExtension().extendMarkdown(md)
+        return md.convert(text) + '\n'
+
+    def test_directory(self):
+        for jobs in ('1', '2'):
+            mdx_latex.main(['-o', self.outdir, '-j', jobs, self.indir])
+            for name, text in self.texts.items():
+                outpath = os.path.join(self.outdir,
+                                       os.path.splitext(name)[0] + '.tex')
+                with open(outpath) as fo:
+                    assert fo.read() == self.expected(text)
+            assert not os.path.exists(os.path.join(self.outdir, 'notes.tex'))
+
+    def test_file_modes(self):
+        outpath = os.path.join(self.outdir, 'one.tex')
+        mdx_latex.main(['-o', self.outdir, self.indir])
+        assert stat.S_IMODE(os.stat(outpath).st_mode) == \
+            0o666 & ~mdx_latex.umask
+        # a file written again keeps its mode
+        os.chmod(outpath, 0o640)
+        mdx_latex.main(['-o', self.outdir, self.indir])
+        assert stat.S_IMODE(os.stat(outpath).st_mode) == 0o640
+
+    def test_template_slots(self):
+        tmpl = os.path.join(self.indir, 'template.tex')
+        with open(tmpl, 'w') as fo:
+            fo.write('% INSERT-TITLE-HERE\nINSERT-TEXT-HERE\n')
+        mdx_latex.main(['-o', self.outdir, '-j', '2', '-t', tmpl,
+                        '--slot', 'title=Report', self.indir])
+        with open(os.path.join(self.outdir, 'one.tex')) as fo:
+            assert fo.read() == '%% Report\n%s\n' % self.expected(
+                self.texts['one.md'])
+
+    def test_same_names(self, capsys):
+        other = os.path.join(self.tmp, 'other')
+        os.mkdir(other)
+        with open(os.path.join(other, 'one.md'), 'w') as fo:
+            fo.write('Another one.')
+        # in and other, but not out
+        pattern = os.path.join(self.tmp, '*', 'one.md')
+        for args in [[self.indir, other], [pattern]]:
+            try:
+                mdx_latex.main(['-o', self.outdir] + args)
+            except SystemExit as inst:
+                assert inst.code == 2
+            else:
+                assert False, 'expected the batch to fail'
+            assert 'would both be written to' in capsys.readouterr().err
+        assert os.listdir(self.outdir) == []
+        # naming the same file twice is fine
+        path = os.path.join(other, 'one.md')
+        mdx_latex.main(['-o', self.outdir, path, path])
+        assert os.listdir(self.outdir) == ['one.tex']
+
+    def test_errors_reported(self, capsys):
+        missing = os.path.join(self.indir, 'missing.md')
+        pattern = os.path.join(self.indir, '*.md')
+        try:
+            mdx_latex.main(['-o', self.outdir, '-j', '2', missing, pattern])
+        except SystemExit as inst:
+            assert inst.code == 1
+        else:
+            assert False, 'expected the batch to fail'
+        assert missing in capsys.readouterr().err
+        # the other files are still converted
+        with open(os.path.join(self.outdir, 'one.tex')) as fo:
+            assert fo.read() == self.expected(self.texts['one.md'])
@@ -11,7 +11,7 @@ setup(
         'console_scripts': ['markdown2latex.py = mdx_latex:main']
     },
     install_requires=[
-        'Markdown>=3.4.1',
+        'Markdown>=3.4.1,<4',
     ],
 
     # metadata for upload to PyPI